@@ -3,18 +3,100 @@
 import re, collections
 from xml import sax
 
-__all__ = ('XMLError', 'ContentHandler', 'parser')
+__all__ = ('XMLError', 'ContentHandler', 'parser', 'iterparse')
 
 class XMLError(Exception): pass
 
-def parser(handler=None):
+def parser(handler=None, native=None):
     """A shortcut for sax.make_parser() followed by a
-    setContentHandler()."""
+    setContentHandler().
+
+    When native is true, the reader's own namespace processing is
+    turned on if it has any; the reader then calls startElementNS and
+    the *PrefixMapping handlers directly.  It defaults to the
+    handler's native attribute, which is false for a ContentHandler.
+    The handler's native attribute is set to the mode in use."""
+
     parse = sax.make_parser()
+    if native is None:
+        native = getattr(handler, 'native', False)
+    if native:
+        try:
+            parse.setFeature(sax.handler.feature_namespaces, True)
+        except (sax.SAXNotRecognizedException, sax.SAXNotSupportedException):
+            native = False
     if handler:
+        if isinstance(handler, ContentHandler):
+            handler.native = native
         parse.setContentHandler(handler)
     return parse
 
+def iterparse(source, events=None, size=65536):
+    """Parse source incrementally and generate (event, name, value)
+    items.  Source may be a file, a socket, or an iterable of byte
+    strings; a file or socket is read size bytes at a time, and
+    nothing more is read until the events of the last chunk have been
+    consumed.  Memory is bounded by the chunk size and the nesting
+    depth of the document, not its length.
+
+    The events are:
+
+        ('start', name, attrs)     attrs is a dict of name -> value
+        ('end', name, None)
+        ('data', None, data)
+        ('start-ns', prefix, uri)
+        ('end-ns', prefix, None)
+
+    Names are (uri, local-name) items.  Pass a sequence of event
+    names to generate only those.
+
+    >>> chunks = ['<a xmlns="urn:A"><b x=', '"1">text</b', '></a>']
+    >>> for item in iterparse(chunks, ('start', 'end', 'data')):
+    ...     print item
+    ('start', (u'urn:A', u'a'), {})
+    ('start', (u'urn:A', u'b'), {(None, u'x'): u'1'})
+    ('data', None, u'text')
+    ('end', (u'urn:A', u'b'), None)
+    ('end', (u'urn:A', u'a'), None)
+    """
+
+    collect = EventCollector(events)
+    reader = parser(collect)
+    queue = collect.queue
+
+    for chunk in read_chunks(source, size):
+        reader.feed(chunk)
+        if queue:
+            for item in queue:
+                yield item
+            del queue[:]
+
+    reader.close()
+    for item in queue:
+        yield item
+    del queue[:]
+
+def read_chunks(source, size=65536):
+    """Generate the byte strings of source: a file-like object, a
+    socket, a string, or an iterable of strings."""
+
+    if isinstance(source, basestring):
+        for start in xrange(0, len(source), size):
+            yield source[start:start + size]
+        return
+
+    read = getattr(source, 'read', None) or getattr(source, 'recv', None)
+    if read is None:
+        for chunk in source:
+            yield chunk
+        return
+
+    while True:
+        chunk = read(size)
+        if not chunk:
+            break
+        yield chunk
+
 
 ### ContentHandler
 
@@ -30,6 +112,14 @@ class ContentHandler(object):
     names of opening and closing tags must match since the reader is
     not namespace aware.
 
+    A subclass that sets native = True, or a reader made with
+    parser(handler, native=True), has the reader process namespaces
+    itself instead, and its events go straight to the subclass.  This
+    is much faster, but there are differences: nsmap is not kept up to
+    date, qname is None, attrs is the reader's AttributesNSImpl, an
+    unprefixed attribute has no namespace, and every xmlns declaration
+    produces a *PrefixMapping event, in document order.
+
     >>> class EchoHandler(ContentHandler):
     ...     def startPrefixMapping(self, prefix, uri):
     ...         print 'start-ns', prefix, uri
@@ -57,8 +147,23 @@ class ContentHandler(object):
     end-ns None
     end-ns foo
     >>> reader.close()
+
+    >>> reader = parser(EchoHandler(), native=True)
+    >>> reader.feed('<foo:bar xmlns="urn:DEFAULT" xmlns:foo="urn:FOO">quux</foo:bar>') # doctest: +ELLIPSIS
+    start-ns None urn:DEFAULT
+    start-ns foo urn:FOO
+    start-el (u'urn:FOO', u'bar') <xml.sax.xmlreader.AttributesNSImpl instance at ...>
+    data quux
+    end-el (u'urn:FOO', u'bar')
+    end-ns foo
+    end-ns None
+    >>> reader.close()
     """
 
+    ## Translate *Element events; see parser() for the reader's own
+    ## namespace processing.
+    native = False
+
     def __init__(self):
         self.reset()
 
@@ -67,6 +172,7 @@ class ContentHandler(object):
         self._prefix_stack = []
         self._delay_attrs = []
         self._attrs = AttributeNS(self.nsmap)
+        self._names = QNameCache(self.nsmap)
 
     ## Implement these in a subclass
 
@@ -107,13 +213,15 @@ class ContentHandler(object):
 
     def startElement(self, qname, attrs):
         nsmap = self.nsmap
+        names = self._names
 
         ## First, process the attributes to find any xmlns
         ## declarations.
-        frame = []
+        nsmap.push()
+        declared = False
         delay = self._delay_attrs; del delay[:]
         for (attr_qname, value) in attrs.items():
-            (prefix, lname) = prefix_name(attr_qname)
+            (prefix, lname) = names.split(attr_qname)
 
             ## An xmlns="..." attribute is equivalent to
             ## xmlns:None="..."
@@ -122,20 +230,21 @@ class ContentHandler(object):
 
             if prefix == 'xmlns':
                 if nsmap.get(lname) != value:
-                    frame.append(lname)
+                    if not declared:
+                        names.push(); declared = True
                     nsmap[lname] = value
                     self.startPrefixMapping(lname, value)
             else:
-                delay.append((prefix, lname, value))
+                delay.append((attr_qname, value))
 
         ## Postprocess non-xmlns attributes.
         _attrs = self._attrs._clear()
-        for (prefix, lname, value) in delay:
-            _attrs._set(map_xml_name(nsmap, prefix, lname), value)
+        for (attr_qname, value) in delay:
+            _attrs._set(names(attr_qname), value)
 
         ## Process the tag name
-        name = map_qname(nsmap, qname)
-        self._prefix_stack.append((name, frame))
+        name = names(qname)
+        self._prefix_stack.append(name)
 
         ## Dispatch
         self.startElementNS(name, qname, _attrs)
@@ -145,8 +254,8 @@ class ContentHandler(object):
             raise XMLError('Unexpected closing tag: %r.' % qname)
 
         nsmap = self.nsmap
-        name = map_qname(nsmap, qname)
-        (start_name, frame) = self._prefix_stack.pop()
+        name = self._names(qname)
+        start_name = self._prefix_stack.pop()
 
         if name != start_name:
             raise XMLError('Expected closing %r, not %r.' % (
@@ -156,22 +265,78 @@ class ContentHandler(object):
 
         self.endElementNS(name, qname)
 
-        for prefix in reversed(frame):
+        prefixes = nsmap.scope()
+        for prefix in prefixes:
             self.endPrefixMapping(prefix)
-            del nsmap[prefix]
+        nsmap.pop()
+        if prefixes:
+            self._names.pop()
+
+class EventCollector(ContentHandler):
+    """Queue namespace events as (event, name, value) items for
+    iterparse().  Handlers for events that were not asked for are
+    left as they are, so those events cost nothing."""
+
+    EVENTS = ('start', 'end', 'data', 'start-ns', 'end-ns')
+
+    ## The events carry only names and values, so the reader's own
+    ## namespace processing will do.
+    native = True
+
+    def __init__(self, events=None):
+        super(EventCollector, self).__init__()
+        self.queue = []
+
+        wanted = set(self.EVENTS if events is None else events)
+        unknown = wanted.difference(self.EVENTS)
+        if unknown:
+            raise ValueError('Unknown events: %s.' % ', '.join(sorted(unknown)))
+
+        add = self.queue.append
+        if 'start' in wanted:
+            self.startElementNS = lambda name, qname, attrs: add(('start', name, dict(attrs.items())))
+        if 'end' in wanted:
+            self.endElementNS = lambda name, qname: add(('end', name, None))
+        if 'data' in wanted:
+            self.characters = lambda data: add(('data', None, data))
+        if 'start-ns' in wanted:
+            self.startPrefixMapping = lambda prefix, uri: add(('start-ns', prefix, uri))
+        if 'end-ns' in wanted:
+            self.endPrefixMapping = lambda prefix: add(('end-ns', prefix, None))
 
 
 ### Aux
 
 class NSMap(object):
-    """An NSMap maps prefixes to namespace URIs.  It is essentially a
-    dictionary, but each prefix is associated with a stack rather than
-    a direct mapping.  A reverse mapping of (uri, prefix) items is
-    also maintained; use the prefix() method to access it."""
+    """An NSMap maps prefixes to namespace URIs.  The bindings are kept
+    on one flat stack, and each entry remembers the URI it shadows, so
+    removing it restores the previous binding.  push() and pop()
+    bracket a scope such as an element; pop() truncates the stack back
+    to where push() left it, which costs nothing for the many elements
+    that declare no namespaces.  The current bindings are also kept in
+    a dictionary for lookups; use the prefix() method for a reverse
+    lookup.
+
+    >>> nsmap = NSMap({None: None})
+    >>> nsmap.push(); nsmap['a'] = 'urn:A'
+    >>> nsmap.push(); nsmap['a'] = 'urn:B'; nsmap[None] = 'urn:D'
+    >>> nsmap['a'], nsmap.prefix('urn:D'), nsmap.scope()
+    ('urn:B', None, [None, 'a'])
+    >>> nsmap.pop(); nsmap['a'], nsmap.prefix('urn:D', 'none')
+    ('urn:A', 'none')
+    >>> nsmap.pop(); 'a' in nsmap
+    False
+    """
+
+    __slots__ = ('_current', '_stack', '_scopes', '_frozen')
 
     def __init__(self, data=None):
-        self.data = {}
-        self.rmap = {}
+        self._current = {}
+        ## Entries are (prefix, uri, shadowed) items.
+        self._stack = []
+        ## The length of the stack when each open scope began.
+        self._scopes = []
+        self._frozen = None
         if data:
             self.update(data)
 
@@ -182,63 +347,88 @@ class NSMap(object):
         )
 
     def __iter__(self):
-        return iter(self.data)
+        return iter(self._current)
 
     def __len__(self):
-        return len(self.data)
+        return len(self._current)
 
     def __contains__(self, key):
-        return key in self.data
+        return key in self._current
 
     def __getitem__(self, key):
-        uris = self.data.get(key)
-        if not uris:
-            raise KeyError(key)
-        return uris[-1]
+        return self._current[key]
 
     def get(self, key, default=None):
-        uris = self.data.get(key)
-        return uris[-1] if uris else default
+        return self._current.get(key, default)
 
     def prefix(self, uri, default=None):
-        prefix = self.rmap.get(uri)
-        return prefix[-1] if prefix else default
+        current = self._current
+        for (prefix, bound, shadowed) in reversed(self._stack):
+            if bound == uri and current.get(prefix, UNBOUND) == uri:
+                return prefix
+        return default
 
     def __setitem__(self, key, value):
-        self.__set(self.data, key, value)
-        self.__set(self.rmap, value, key)
-
-    def __set(self, data, key, value):
-        values = data.get(key)
-        if not values:
-            data[key] = [value]
-        elif values[-1] != value:
-            values.append(value)
+        current = self._current
+        self._stack.append((key, value, current.get(key, UNBOUND)))
+        current[key] = value
+        self._frozen = None
 
     def __delitem__(self, key):
-        uris = self.data.get(key)
-        if not uris:
-            raise KeyError(key)
-        self.__del(self.rmap, uris[-1])
-        self.__del(self.data, key)
+        """Remove the most recent binding of key."""
 
-    def __del(self, data, key):
-        values = data.get(key)
-        if not values:
-            return False
-
-        if len(values) == 1:
-            del data[key]
+        stack = self._stack
+        for index in xrange(len(stack) - 1, -1, -1):
+            if stack[index][0] == key:
+                break
         else:
-            values.pop()
+            raise KeyError(key)
 
-        return True
+        self._restore(*stack.pop(index))
+        if self._scopes and self._scopes[-1] > index:
+            self._scopes = [m - 1 if m > index else m for m in self._scopes]
+
+    def push(self):
+        """Begin a scope."""
+        self._scopes.append(len(self._stack))
+
+    def scope(self):
+        """The prefixes bound since the last push(), most recent
+        first."""
+
+        stack = self._stack; mark = self._scopes[-1]
+        if len(stack) == mark:
+            return ()
+        return [stack[i][0] for i in xrange(len(stack) - 1, mark - 1, -1)]
+
+    def pop(self):
+        """End the scope begun by the last push() and remove the
+        bindings made in it."""
+
+        stack = self._stack; mark = self._scopes.pop()
+        if len(stack) > mark:
+            for i in xrange(len(stack) - 1, mark - 1, -1):
+                self._restore(*stack[i])
+            del stack[mark:]
+
+    def freeze(self):
+        """A read-only snapshot of the current bindings.  The same
+        snapshot is returned until the bindings change."""
+
+        if self._frozen is None:
+            rmap = {}
+            current = self._current
+            for (prefix, uri, shadowed) in self._stack:
+                if current.get(prefix, UNBOUND) == uri:
+                    rmap[uri] = prefix
+            self._frozen = FrozenNSMap(dict(current), rmap)
+        return self._frozen
 
     def items(self):
-        return list(self.iteritems())
+        return self._current.items()
 
     def iteritems(self):
-        return ((k, v[-1]) for (k, v) in self.data.iteritems())
+        return self._current.iteritems()
 
     def update(self, data):
         if isinstance(data, collections.Mapping):
@@ -246,12 +436,167 @@ class NSMap(object):
         for (key, value) in data:
             self[key] = value
 
-class AttributeNS(object):
-    """An implementation of the SAX AttributeNS interface."""
+    def _restore(self, prefix, uri, shadowed):
+        if shadowed is UNBOUND:
+            del self._current[prefix]
+        else:
+            self._current[prefix] = shadowed
+        self._frozen = None
+
+## Marks a prefix that had no binding to shadow.
+UNBOUND = object()
+
+class FrozenNSMap(object):
+    """A snapshot of an NSMap's bindings; see NSMap.freeze()."""
+
+    __slots__ = ('_current', '_rmap')
+
+    def __init__(self, current, rmap):
+        self._current = current
+        self._rmap = rmap
+
+    def __repr__(self):
+        return '<%s [%s]>' % (
+            type(self).__name__,
+            ', '.join(repr(i) for i in self.iteritems())
+        )
+
+    def __iter__(self):
+        return iter(self._current)
+
+    def __len__(self):
+        return len(self._current)
+
+    def __contains__(self, key):
+        return key in self._current
+
+    def __getitem__(self, key):
+        return self._current[key]
+
+    def get(self, key, default=None):
+        return self._current.get(key, default)
+
+    def prefix(self, uri, default=None):
+        return self._rmap.get(uri, default)
+
+    def freeze(self):
+        return self
+
+    def items(self):
+        return self._current.items()
+
+    def iteritems(self):
+        return self._current.iteritems()
+
+class QNameCache(object):
+    """Resolve qualified names against an NSMap and remember the
+    results.  Splitting a qname into its prefix and local name does not
+    depend on the bindings, so those are kept for good.  Resolved names
+    do, so they belong to a scope: push() sets them aside when a scope
+    changes a binding and pop() brings them back when it ends.
+    Resolved names are interned, so equal names are usually the same
+    tuple.  The table of interned names is emptied when it reaches
+    limit, like the others, so a name resolved before and after that
+    is equal but not always identical; compare names with ==.
+
+    >>> nsmap = NSMap({None: None, 'a': 'urn:A'})
+    >>> resolve = QNameCache(nsmap)
+    >>> resolve('a:b'), resolve('a:b') is resolve('a:b')
+    (('urn:A', 'b'), True)
+    >>> nsmap.push(); nsmap['a'] = 'urn:B'; resolve.push()
+    >>> resolve('a:b')
+    ('urn:B', 'b')
+    >>> nsmap.pop(); resolve.pop(); resolve.names
+    {'a:b': ('urn:A', 'b')}
+
+    Every table is bounded, however many bindings a document makes.
+
+    >>> class Last(ContentHandler):
+    ...     def startElementNS(self, name, qname, attrs):
+    ...         self.last = name
+    >>> handler = Last(); reader = parser(handler)
+    >>> reader.feed('<a:r xmlns:a="urn:A">')
+    >>> for i in xrange(20000):
+    ...     reader.feed('<a:b xmlns:a="urn:%d"/>' % i)
+    >>> handler.last
+    (u'urn:19999', u'b')
+    >>> reader.feed('<a:b/></a:r>'); reader.close(); handler.last
+    (u'urn:A', u'b')
+    >>> cache = handler._names
+    >>> (len(cache.saved), len(cache.names) <= cache.limit, len(cache.interned) <= cache.limit)
+    (0, True, True)
+    """
+
+    ## Forget everything beyond this many names, so that documents
+    ## with endless distinct names cannot grow the cache without
+    ## bound.
+    limit = 4096
 
     def __init__(self, nsmap):
         self.nsmap = nsmap
-        self.data = {}
+        self.names = {}
+        ## The names of the enclosing scopes.
+        self.saved = []
+        self.parts = {}
+        self.interned = {}
+
+    def __call__(self, qname):
+        try:
+            return self.names[qname]
+        except KeyError:
+            pass
+
+        (prefix, lname) = self.split(qname)
+        name = map_xml_name(self.nsmap, prefix, lname)
+        interned = self.interned
+        if len(interned) >= self.limit:
+            interned.clear()
+        name = interned.setdefault(name, name)
+
+        names = self.names
+        if len(names) >= self.limit:
+            names.clear()
+        names[qname] = name
+        return name
+
+    def split(self, qname):
+        try:
+            return self.parts[qname]
+        except KeyError:
+            pass
+
+        parts = self.parts
+        if len(parts) >= self.limit:
+            parts.clear()
+        parts[qname] = result = prefix_name(qname)
+        return result
+
+    def push(self):
+        """Begin a scope that changes a binding."""
+        self.saved.append(self.names)
+        self.names = {}
+
+    def pop(self):
+        """End the scope begun by the last push()."""
+        self.names = self.saved.pop()
+
+class AttributeNS(object):
+    """An implementation of the SAX AttributeNS interface.  The
+    ContentHandler reuses one for every element; use copy() to keep
+    the attributes of an element.
+
+    >>> nsmap = NSMap({None: None, 'a': 'urn:A'})
+    >>> attrs = AttributeNS(nsmap); attrs._set(('urn:A', 'x'), '1')
+    >>> kept = attrs.copy(); nsmap['a'] = 'urn:B'; attrs = attrs._clear()
+    >>> kept.items(), kept.getQNameByName(('urn:A', 'x'))
+    ([(('urn:A', 'x'), '1')], 'a:x')
+    """
+
+    __slots__ = ('nsmap', 'data')
+
+    def __init__(self, nsmap, data=None):
+        self.nsmap = nsmap
+        self.data = {} if data is None else data
 
     def __repr__(self):
         return '<%s [%s]>' % (
@@ -272,12 +617,12 @@ class AttributeNS(object):
         return self.data[key]
 
     def copy(self):
-        result = AttributeNS(dict(self.nsmap.iteritems()))
-        result.data = NSMap(self.data)
-        return result
+        """A copy whose namespace bindings are a frozen snapshot,
+        shared by the copies made while the bindings stay the same."""
+        return AttributeNS(self.nsmap.freeze(), dict(self.data))
 
     def get(self, key, default=None):
-        self.data.get(key, default)
+        return self.data.get(key, default)
 
     def has_key(self, key):
         return key in self.data
@@ -325,7 +670,7 @@ class AttributeNS(object):
         return self.getValue(self.getNameByQName(qname))
 
     def getNameByQName(self, qname):
-        return map_xml_name(self.nsmap(qname))
+        return map_qname(self.nsmap, qname)
 
     def getQNameByName(self, name):
         return map_name(self.nsmap, name)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+"""saxpar -- parse the records of a large XML file in parallel
+
+Many large documents are one root element holding a long run of
+independent records: <feed><entry/><entry/>...</feed>.  The file is
+mapped with mmap and cut into byte ranges at record start tags.  Each
+range is parsed by a worker process with its own saxns.ContentHandler;
+the worker reads the range straight from its own mapping of the file.
+Each handler sees the root's start tag (with its namespace
+declarations, so its NSMap is seeded with the root's bindings), its
+share of the records, and the root's end tag.  The handler's result()
+for each range is returned in document order.
+
+Records are found by scanning for their start tag, so the text of that
+tag must not appear inside a record's comments or CDATA sections, and
+the document must not rely on a DOCTYPE.  Nor may a record hold an
+element of its own name, since the scan does not track depth: when
+one turns up in the start of the body the file is not cut, and it is
+parsed serially as one range.  Unless the record element is named, it
+is the child of the root that takes up the most of the start of the
+body; a feed's own title or links before its entries are not taken
+for records.
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp('.xml')
+    >>> with open(path, 'w') as file:
+    ...     file.write('<?xml version="1.0"?>\\n<f:feed xmlns:f="urn:F">')
+    ...     file.write('<f:title>Feed</f:title><f:link href="/"/>\\n')
+    ...     for i in xrange(100):
+    ...         file.write('<f:entry n="%d"><f:x/></f:entry>\\n' % i)
+    ...     file.write('</f:feed>\\n')
+    >>> sum(parse(path, counter, parts=7, workers=2))
+    102
+    >>> len(ranges(path, parts=7))
+    7
+    >>> with open(path, 'w') as file:
+    ...     file.write('<feed>')
+    ...     for i in xrange(100):
+    ...         file.write('<entry><entry/></entry>\\n')
+    ...     file.write('</feed>')
+    >>> ranges(path, parts=7)
+    [(6, 2406)]
+    >>> import os; os.remove(path)
+
+Example:
+
+    > saxpar.py feed.xml 2
+    200200 records in 8 ranges, 2 workers: 4.655s
+"""
+
+import sys, re, mmap, time, multiprocessing
+import saxns
+
+__all__ = ('parse', 'imap', 'ranges', 'counter')
+
+def usage():
+    print __doc__
+    print 'usage: %s file [workers]' % sys.argv[0]
+    sys.exit(1)
+
+def parse(path, factory, record=None, workers=None, parts=None, native=None):
+    """Parse path in parallel and return the list of results, one for
+    each range, in document order.  See imap()."""
+    return list(imap(path, factory, record, workers, parts, native))
+
+def imap(path, factory, record=None, workers=None, parts=None, native=None):
+    """Generate the results of parsing path in parallel, one for each
+    range, in document order.  Factory is called in each worker to
+    make a saxns.ContentHandler with a result() method; it must be
+    picklable, for example a class defined at module level.  Record
+    is the qualified name of the record elements as written in the
+    file.  By default it is guessed: the child of the root whose
+    elements take up the most of the first SAMPLE bytes of the body.
+    Name it when records are so large or so few that the guess could
+    be wrong.  The file is cut into parts ranges, by default four for
+    each worker.  Native is passed on to saxns.parser(); by default
+    the handler's own native attribute decides."""
+
+    workers = workers or multiprocessing.cpu_count()
+    parts = parts or 4 * workers
+
+    (head, tail, cuts) = layout(path, record, parts)
+    tasks = [
+        (path, head, tail, start, end, factory, native)
+        for (start, end) in zip(cuts, cuts[1:])
+    ]
+
+    if workers == 1:
+        for task in tasks:
+            yield work(task)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(work, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def ranges(path, record=None, parts=4):
+    """The (start, end) byte ranges that path is cut into."""
+    cuts = layout(path, record, parts)[2]
+    return zip(cuts, cuts[1:])
+
+def work(task):
+    (path, head, tail, start, end, factory, native) = task
+
+    handler = factory()
+    reader = saxns.parser(handler, native)
+    with open(path, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            reader.feed(head)
+            for pos in xrange(start, end, CHUNK):
+                reader.feed(data[pos:min(pos + CHUNK, end)])
+            reader.feed(tail)
+            reader.close()
+        finally:
+            data.close()
+    return handler.result()
+
+CHUNK = 65536
+
+
+### Layout
+
+## The root's start tag: a name followed by attributes whose quoted
+## values may hold '>'.
+START_TAG = re.compile(r'<([^\s/>!?]+)(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*>')
+DECLARATION = re.compile(r'<\?xml\s[^?]*\?>')
+MARKUP = re.compile(r'<(?:!--.*?-->|\?.*?\?>|!\[CDATA\[.*?\]\]>|![^>]*>)', re.S)
+
+def layout(path, record=None, parts=4):
+    """Find the XML declaration and the root's start tag, which make
+    the head of each range, the root's end tag, and the offsets where
+    ranges begin and end."""
+
+    with open(path, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _layout(data, record, parts)
+        finally:
+            data.close()
+
+def _layout(data, record, parts):
+    declaration = DECLARATION.match(data, 0)
+    head = declaration.group(0) if declaration else ''
+
+    root = root_tag(data, declaration.end() if declaration else 0)
+    if not root:
+        raise saxns.XMLError('No root element found.')
+    head += root.group(0)
+    qname = root.group(1)
+
+    tail = '</%s>' % qname
+    body_start = root.end()
+    body_end = data.rfind(tail)
+    if body_end < body_start:
+        raise saxns.XMLError('No closing %r tag found.' % qname)
+
+    (sizes, nested) = survey(data, body_start, min(body_end, body_start + SAMPLE))
+    if record is None:
+        record = max(sizes, key=sizes.get) if sizes else None
+    if record is None or record in nested:
+        ## A cut at a nested start tag would split a record.
+        return (head, tail, [body_start, body_end])
+
+    cuts = [body_start]
+    size = max(1, (body_end - body_start) // parts)
+    for part in xrange(1, parts):
+        cut = find_start(data, record, max(body_start + part * size, cuts[-1] + 1), body_end)
+        if cut < 0:
+            break
+        if cut > cuts[-1]:
+            cuts.append(cut)
+    cuts.append(body_end)
+    return (head, tail, cuts)
+
+def root_tag(data, pos, end=None):
+    """Match the first start tag at or after pos, skipping comments,
+    processing instructions, CDATA sections and declarations."""
+
+    end = len(data) if end is None else end
+    while True:
+        pos = data.find('<', pos, end)
+        if pos < 0:
+            return None
+        skip = MARKUP.match(data, pos)
+        if skip:
+            pos = skip.end()
+            continue
+        return START_TAG.match(data, pos)
+
+## Bytes of the body that survey() looks at.
+SAMPLE = 1 << 20
+
+TAG = re.compile(r'<(/?)([^\s/>!?]+)(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>')
+
+def survey(data, pos, end):
+    """Walk the elements between pos and end.  Return the bytes taken
+    up by the children of each qualified name, and the set of names
+    found further down.  Records are what a long body is made of, so
+    the name with the most bytes is the likely record even where other
+    elements come first or outnumber it.
+
+    >>> (sizes, nested) = survey('<t>x</t><l/><l/><e><l/>abc</e><e>def', 0, 36)
+    >>> sorted(sizes.items()), nested
+    ([('e', 20), ('l', 8), ('t', 8)], set(['l']))
+    """
+
+    sizes = {}; nested = set(); depth = 0; start = name = None
+    while True:
+        pos = data.find('<', pos, end)
+        if pos < 0:
+            break
+        skip = MARKUP.match(data, pos)
+        if skip:
+            pos = skip.end()
+            continue
+        tag = TAG.match(data, pos)
+        if not tag or tag.end() > end:
+            break
+        if tag.group(1):
+            depth -= 1
+            if depth == 0:
+                sizes[name] = sizes.get(name, 0) + tag.end() - start
+        else:
+            if depth == 0:
+                (start, name) = (pos, tag.group(2))
+                if tag.group(3):
+                    sizes[name] = sizes.get(name, 0) + tag.end() - start
+            else:
+                nested.add(tag.group(2))
+            if not tag.group(3):
+                depth += 1
+        pos = tag.end()
+
+    if depth > 0:
+        ## The sample ends inside this child.
+        sizes[name] = sizes.get(name, 0) + end - start
+    return (sizes, nested)
+
+def find_start(data, qname, pos, end):
+    """The offset of the next <qname start tag at or after pos, or
+    -1."""
+
+    tag = '<' + qname
+    while True:
+        pos = data.find(tag, pos, end)
+        if pos < 0:
+            return pos
+        after = pos + len(tag)
+        if after < end and data[after] in ' \t\r\n/>':
+            return pos
+        pos = after
+
+
+### Handlers
+
+class counter(saxns.ContentHandler):
+    """Count the records in a range: the elements one level below the
+    root."""
+
+    native = True
+
+    def __init__(self):
+        super(counter, self).__init__()
+        self.depth = 0
+        self.count = 0
+
+    def startElementNS(self, name, qname, attrs):
+        self.depth += 1
+        if self.depth == 2:
+            self.count += 1
+
+    def endElementNS(self, name, qname):
+        self.depth -= 1
+
+    def result(self):
+        return self.count
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        usage()
+    path = sys.argv[1]
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+
+    start = time.time()
+    counts = parse(path, counter, workers=workers)
+    print '%d records in %d ranges, %d workers: %.3fs' % (
+        sum(counts), len(counts), workers, time.time() - start
+    )
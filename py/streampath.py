@@ -0,0 +1,738 @@
+#!/usr/bin/env python
+
+"""streampath -- match a streamable subset of XPath against SAX events
+
+An expression is tokenized by lexpath, parsed, and compiled into a
+pushdown automaton.  The automaton is driven by element start and end
+events: each open element has a frame on its stack holding the steps
+of the path that could match its children.  Nothing else is kept, so
+memory is bounded by the depth of the document and a few elements can
+be picked out of a very large one in a single pass.
+
+The subset is location paths made of child and descendant steps
+(/, //, child::, descendant::) with name tests (name, prefix:name, *,
+prefix:*) and predicates built from attributes, literals, numbers,
+position(), not(), comparisons, and/or.  A number alone is short for
+position() = number.  Attribute steps, reverse axes, and last() need
+more than the current element and are not supported.  Neither are
+positions on an explicit descendant:: step, which count in document
+order rather than among the children of one parent as they do after
+//.
+
+    >>> doc = ('<feed><entry id="1" type="a"/><entry id="2"><x/></entry>'
+    ...        '<entry id="3" type="a"><x/></entry></feed>')
+    >>> [attrs[(None, 'id')] for (name, attrs) in select('/feed/entry[@type="a"]', [doc])]
+    [u'1', u'3']
+    >>> [attrs[(None, 'id')] for (name, attrs) in select('//entry[2]', [doc])]
+    [u'2']
+    >>> [name for (name, attrs) in select('//entry[x][@id>2]/*', [doc])]
+    Traceback (most recent call last):
+      ...
+    XPathError: Expected a comparison or a number in a predicate, not 'x'.
+    >>> [name for (name, attrs) in select('//entry[@id>2]/*', [doc])]
+    [(None, u'x')]
+    >>> list(select('/feed/descendant::entry[2]', [doc]))
+    Traceback (most recent call last):
+      ...
+    XPathError: Positions on the descendant axis are not supported; use //.
+
+An Index merges many paths into one trie and reports the ones that
+match a document in a single pass; see Index.
+
+Names are (uri, local-name) items, as saxns produces them.  Prefixes
+in an expression are resolved with the nsmap given to compile(); its
+None entry, if any, is the namespace of unprefixed element names.
+
+Example:
+
+    > streampath.py '//entry[@type="a"]' feed.xml
+    {urn:feed}entry
+    ...
+"""
+
+import sys
+import lexpath, saxns
+
+__all__ = (
+    'XPathError', 'compile', 'select', 'Path', 'Automaton', 'Matcher',
+    'Index', 'IndexAutomaton', 'IndexMatcher'
+)
+
+class XPathError(Exception): pass
+
+def usage():
+    print __doc__
+    print 'usage: %s expression file' % sys.argv[0]
+    sys.exit(1)
+
+def compile(expr, nsmap=None):
+    """Compile expr into a Path.  See the module documentation for
+    the subset of XPath that is understood."""
+    return Path(expr, Parser(lexpath.tokenize(expr), nsmap or {}).path())
+
+def select(expr, source, nsmap=None):
+    """Generate a (name, attrs) item for each element of source that
+    matches expr, which may be a compiled Path.  Source is anything
+    saxns.iterparse() accepts."""
+
+    path = expr if isinstance(expr, Path) else compile(expr, nsmap)
+    automaton = path.automaton()
+    start = automaton.start; end = automaton.end
+    for (event, name, value) in saxns.iterparse(source, ('start', 'end')):
+        if event == 'start':
+            if start(name, value):
+                yield (name, value)
+        else:
+            end()
+
+
+### Automaton
+
+class Path(object):
+    """A compiled expression: a sequence of Steps."""
+
+    def __init__(self, expr, steps):
+        self.expr = expr
+        self.steps = tuple(steps)
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.expr)
+
+    def automaton(self):
+        return Automaton(self.steps)
+
+class Step(object):
+    """One location step.  The name test is a uri and local name;
+    ANY in either place is a wildcard."""
+
+    __slots__ = ('descendant', 'uri', 'lname', 'predicates', 'key')
+
+    def __init__(self, descendant, uri, lname, predicates, key=None):
+        self.descendant = descendant
+        self.uri = uri
+        self.lname = lname
+        self.predicates = tuple(predicates)
+        ## Steps with the same key are the same test; an Index merges
+        ## them.
+        self.key = key or (descendant, uri, lname, self.predicates)
+
+    def __repr__(self):
+        return '<%s %s%s%s>' % (
+            type(self).__name__,
+            '//' if self.descendant else '/',
+            '*' if self.uri is ANY else saxns.make_clark_name((self.uri, '')),
+            '*' if self.lname is ANY else self.lname
+        )
+
+    def test(self, name):
+        return (self.uri is ANY or name[0] == self.uri) and (self.lname is ANY or name[1] == self.lname)
+
+## A wildcard in a name test.
+ANY = object()
+
+class Automaton(object):
+    """Run a Path over a stream of element events.  Each frame on the
+    stack is [states, counts, matched]: the indexes of the steps that
+    the element's children may match, the number of children that
+    have reached each positional predicate, and whether the element
+    itself matched the whole path."""
+
+    __slots__ = ('steps', 'stack')
+
+    def __init__(self, steps):
+        self.steps = steps
+        ## The document node: its child, the root, may match the first
+        ## step.
+        self.stack = [[(0,), None, False]]
+
+    def start(self, name, attrs):
+        """An element has started; return True if it matches."""
+
+        top = self.stack[-1]
+        states = top[0]
+        if not states:
+            self.stack.append(DEAD)
+            return False
+
+        steps = self.steps; final = len(steps)
+        following = []; matched = False
+        for i in states:
+            step = steps[i]
+            if step.descendant and i not in following:
+                following.append(i)
+            if not step.test(name):
+                continue
+
+            for (k, predicate) in enumerate(step.predicates):
+                position = None
+                if predicate.positional:
+                    counts = top[1]
+                    if counts is None:
+                        counts = top[1] = {}
+                    position = counts[i, k] = counts.get((i, k), 0) + 1
+                if not predicate(attrs, position):
+                    break
+            else:
+                if i + 1 == final:
+                    matched = True
+                elif i + 1 not in following:
+                    following.append(i + 1)
+
+        self.stack.append([following, None, matched] if (following or matched) else DEAD)
+        return matched
+
+    def end(self):
+        """An element has ended; return True if it matched."""
+        return self.stack.pop()[2]
+
+## The frame of an element whose descendants cannot match.
+DEAD = ((), None, False)
+
+class Matcher(saxns.ContentHandler):
+    """Drive an Automaton from namespace events and call
+    start(name, attrs) and end(name) for each matching element."""
+
+    def __init__(self, path, start=None, end=None):
+        self.path = path if isinstance(path, Path) else compile(path)
+        self.on_start = start
+        self.on_end = end
+        super(Matcher, self).__init__()
+
+    def reset(self):
+        super(Matcher, self).reset()
+        self._automaton = self.path.automaton()
+
+    def startElementNS(self, name, qname, attrs):
+        if self._automaton.start(name, attrs) and self.on_start:
+            self.on_start(name, attrs)
+
+    def endElementNS(self, name, qname):
+        if self._automaton.end() and self.on_end:
+            self.on_end(name)
+
+
+### Index
+
+class Index(object):
+    """Many Paths merged into a trie and matched in a single pass.
+    Each node of the trie is a Step; paths that begin with the same
+    steps share nodes, and each node lists the keys of the paths that
+    end there.
+
+    A node's children are filed by name test, and those whose first
+    predicate compares an attribute to a constant are filed under the
+    constant too.  The work done for an element depends on its name,
+    its attributes, and the paths it could still match, not on the
+    number of paths in the index.
+
+        >>> index = Index({'x': 'urn:x'})
+        >>> for i in xrange(1000):
+        ...     _ = index.add('/feed/x:item[@id=%d]' % i, i)
+        >>> index.add('//title', 'titles')
+        'titles'
+        >>> index.add('/feed/*[2]')
+        '/feed/*[2]'
+        >>> doc = ('<feed xmlns:x="urn:x"><x:item id="7"><title/></x:item>'
+        ...        '<x:item id="12"/></feed>')
+        >>> sorted(index.match([doc]))
+        [7, 12, '/feed/*[2]', 'titles']
+    """
+
+    def __init__(self, nsmap=None):
+        self.nsmap = nsmap or {}
+        self.root = Node(None)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, expr, key=None, nsmap=None):
+        """Add expr, which may be a compiled Path, and return its key.
+        By default, the key is the expression; prefixes are resolved
+        with nsmap or the index's own."""
+
+        if not isinstance(expr, Path):
+            expr = compile(expr, self.nsmap if nsmap is None else nsmap)
+        key = expr.expr if key is None else key
+
+        node = self.root
+        for step in expr.steps:
+            node = node.extend(step)
+        node.keys.append(key)
+        self.size += 1
+        return key
+
+    def automaton(self):
+        return IndexAutomaton(self.root)
+
+    def match(self, source):
+        """Return the set of keys of the paths that match some element
+        of source, which is anything saxns.iterparse() accepts."""
+
+        matched = set()
+        automaton = self.automaton()
+        start = automaton.start; end = automaton.end
+        for (event, name, value) in saxns.iterparse(source, ('start', 'end')):
+            if event == 'start':
+                keys = start(name, value)
+                if keys:
+                    matched.update(keys)
+            else:
+                end()
+        return matched
+
+class Node(object):
+    """A Step in the trie, the keys of the paths that end with it, and
+    the tables of steps that may follow it on the child and descendant
+    axes."""
+
+    __slots__ = ('step', 'keys', 'edges', 'child', 'descendant')
+
+    def __init__(self, step):
+        self.step = step
+        self.keys = []
+        self.edges = {}
+        self.child = None
+        self.descendant = None
+
+    def extend(self, step):
+        node = self.edges.get(step.key)
+        if node is None:
+            node = self.edges[step.key] = Node(step)
+            if step.descendant:
+                self.descendant = self.descendant or Table()
+                self.descendant.add(node)
+            else:
+                self.child = self.child or Table()
+                self.child.add(node)
+        return node
+
+class Table(object):
+    """Nodes filed by name test: a full name, a uri (prefix:*), or
+    neither (*)."""
+
+    __slots__ = ('names', 'uris', 'any')
+
+    def __init__(self):
+        self.names = {}
+        self.uris = {}
+        self.any = None
+
+    def add(self, node):
+        step = node.step
+        if step.uri is ANY:
+            if self.any is None:
+                self.any = Bucket()
+            self.any.add(node)
+        else:
+            (table, key) = (self.uris, step.uri) if step.lname is ANY else (self.names, (step.uri, step.lname))
+            if key not in table:
+                table[key] = Bucket()
+            table[key].add(node)
+
+    def candidates(self, name, attrs, into):
+        """Add (node, k) items to into for the nodes whose name test
+        matches name; predicates before k are already known to hold."""
+
+        bucket = self.names.get(name)
+        if bucket is not None:
+            bucket.candidates(attrs, into)
+        if self.uris:
+            bucket = self.uris.get(name[0])
+            if bucket is not None:
+                bucket.candidates(attrs, into)
+        if self.any is not None:
+            self.any.candidates(attrs, into)
+
+class Bucket(object):
+    """Nodes with the same name test.  Those whose first predicate is
+    an attribute compared to a constant are kept in a dictionary for
+    each attribute, keyed by the constant."""
+
+    __slots__ = ('nodes', 'equals')
+
+    def __init__(self):
+        self.nodes = []
+        self.equals = {}
+
+    def add(self, node):
+        predicates = node.step.predicates
+        equals = predicates[0].equals if predicates else None
+        if equals is None:
+            self.nodes.append((node, 0))
+        else:
+            (attr, numeric, value) = equals
+            self.equals.setdefault((attr, numeric), {}).setdefault(value, []).append((node, 1))
+
+    def candidates(self, attrs, into):
+        into.extend(self.nodes)
+        for ((attr, numeric), values) in self.equals.iteritems():
+            value = attrs.get(attr)
+            if value is not None:
+                found = values.get(number(value) if numeric else value)
+                if found:
+                    into.extend(found)
+
+class IndexAutomaton(object):
+    """Run an Index over a stream of element events.  Each frame on the
+    stack is [nodes, deep, counts]: the nodes whose child steps the
+    element's children may match, the nodes whose descendant steps
+    they may match, and the number of children that have reached each
+    positional predicate."""
+
+    __slots__ = ('stack',)
+
+    def __init__(self, root):
+        self.stack = [[(root,), (), None]]
+
+    def start(self, name, attrs):
+        """An element has started; return the keys of the paths that
+        it matches."""
+
+        top = self.stack[-1]
+        (nodes, deep) = (top[0], top[1])
+        if not (nodes or deep):
+            self.stack.append(EMPTY)
+            return ()
+
+        ## A node matched by the parent applies its descendant steps
+        ## from here down.
+        for node in nodes:
+            if node.descendant is not None and node not in deep:
+                deep = deep + (node,)
+
+        candidates = []
+        for node in nodes:
+            if node.child is not None:
+                node.child.candidates(name, attrs, candidates)
+        for node in deep:
+            node.descendant.candidates(name, attrs, candidates)
+
+        following = []; matched = ()
+        for (node, first) in candidates:
+            predicates = node.step.predicates
+            for k in xrange(first, len(predicates)):
+                predicate = predicates[k]
+                position = None
+                if predicate.positional:
+                    counts = top[2]
+                    if counts is None:
+                        counts = top[2] = {}
+                    position = counts[node, k] = counts.get((node, k), 0) + 1
+                if not predicate(attrs, position):
+                    break
+            else:
+                following.append(node)
+                if node.keys:
+                    matched += tuple(node.keys)
+
+        self.stack.append([following, deep, None] if (following or deep) else EMPTY)
+        return matched
+
+    def end(self):
+        self.stack.pop()
+
+## The frame of an element whose descendants cannot match.
+EMPTY = ((), (), None)
+
+class IndexMatcher(saxns.ContentHandler):
+    """Drive an IndexAutomaton from namespace events.  The keys of the
+    paths matched by each document are collected in matched, and
+    start(name, attrs, keys) is called for each element that matches
+    some path."""
+
+    def __init__(self, index, start=None):
+        self.index = index
+        self.on_start = start
+        super(IndexMatcher, self).__init__()
+
+    def reset(self):
+        super(IndexMatcher, self).reset()
+        self._automaton = self.index.automaton()
+        self.matched = set()
+
+    def startElementNS(self, name, qname, attrs):
+        keys = self._automaton.start(name, attrs)
+        if keys:
+            self.matched.update(keys)
+            if self.on_start:
+                self.on_start(name, attrs, keys)
+
+    def endElementNS(self, name, qname):
+        self._automaton.end()
+
+
+### Parser
+
+class Parser(object):
+    """A recursive-descent parser over lexpath tokens that produces the
+    Steps of a location path."""
+
+    def __init__(self, tokens, nsmap):
+        self.tokens = tokens
+        self.pos = 0
+        self.nsmap = nsmap
+
+    def peek(self, offset=0):
+        pos = self.pos + offset
+        return self.tokens[pos] if pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise XPathError('Unexpected end of expression.')
+        self.pos += 1
+        return token
+
+    def accept(self, type, value=None):
+        token = self.peek()
+        if token is not None and token.type == type and (value is None or token.value == value):
+            self.pos += 1
+            return token
+        return None
+
+    def expect(self, type, value, what):
+        token = self.accept(type, value)
+        if token is None:
+            self.fail(what)
+        return token
+
+    def fail(self, what):
+        token = self.peek()
+        raise XPathError('Expected %s, not %s.' % (
+            what,
+            'the end of the expression' if token is None else repr(token.value)
+        ))
+
+    ## Location paths
+
+    def path(self):
+        steps = []
+        descendant = bool(self.accept('OPERATOR', '//'))
+        if not descendant:
+            self.accept('OPERATOR', '/')
+
+        while True:
+            steps.append(self.step(descendant))
+            if self.accept('OPERATOR', '/'):
+                descendant = False
+            elif self.accept('OPERATOR', '//'):
+                descendant = True
+            elif self.peek() is None:
+                return steps
+            else:
+                self.fail('/ or //')
+
+    def step(self, descendant):
+        explicit = False
+        axis = self.accept('AXIS')
+        if axis:
+            self.expect('ABBREV', '::', '::')
+            if axis.value == 'descendant':
+                descendant = explicit = True
+            elif axis.value != 'child':
+                raise XPathError('The %s axis is not streamable.' % axis.value)
+        elif self.peek() and self.peek().type == 'ABBREV':
+            raise XPathError('%r steps are not supported.' % self.peek().value)
+
+        name = self.accept('NAME')
+        if name is None:
+            self.fail('a name test')
+        (uri, lname) = self.name_test(name.value)
+
+        predicates = []; first = self.pos
+        while self.accept('BRACKET', '['):
+            predicates.append(self.predicate())
+            self.expect('BRACKET', ']', ']')
+        if explicit and any(predicate.positional for predicate in predicates):
+            ## The automaton counts positions in the frame of the
+            ## parent, which is what // means but not descendant::.
+            raise XPathError('Positions on the descendant axis are not supported; use //.')
+        return Step(descendant, uri, lname, predicates, self.key(descendant, uri, lname, first))
+
+    def key(self, descendant, uri, lname, first):
+        ## Predicates are the same test when their text is, as long as
+        ## the prefixes of attribute names mean the same thing.
+        text = ' '.join(unicode(token.value) for token in self.tokens[first:self.pos])
+        return (descendant, uri, lname, text, tuple(sorted(self.nsmap.items())) if text else None)
+
+    def name_test(self, value):
+        if value == '*':
+            return (ANY, ANY)
+        (prefix, lname) = value.split(':', 1) if ':' in value else (None, value)
+        uri = self.resolve(prefix)
+        return (uri, ANY if lname == '*' else lname)
+
+    def resolve(self, prefix, attribute=False):
+        if prefix is None:
+            return None if attribute else self.nsmap.get(None)
+        try:
+            return self.nsmap[prefix]
+        except KeyError:
+            raise XPathError('Unrecognized prefix: %r.' % prefix)
+
+    ## Predicates
+
+    def predicate(self):
+        token = self.peek()
+        if token is not None and token.type == 'NUMBER' and self.closes(1):
+            self.next()
+            return Predicate(lambda attrs, position: position == token.value, True)
+        return self.or_expr()
+
+    def closes(self, offset):
+        token = self.peek(offset)
+        return token is not None and token.type == 'BRACKET' and token.value == ']'
+
+    def or_expr(self):
+        left = self.and_expr()
+        while self.accept('OPERATOR', 'or'):
+            left = combine(left, self.and_expr(), any)
+        return left
+
+    def and_expr(self):
+        left = self.comparison()
+        while self.accept('OPERATOR', 'and'):
+            left = combine(left, self.comparison(), all)
+        return left
+
+    def comparison(self):
+        left = self.operand()
+        token = self.peek()
+        if token is None or token.type != 'OPERATOR' or token.value not in COMPARE:
+            if left.kind == 'boolean':
+                return left.value
+            if left.kind != 'node':
+                self.fail('a comparison')
+            return Predicate(lambda attrs, position, value=left.value: value(attrs, position) is not None, left.positional)
+
+        self.next()
+        right = self.operand()
+        if left.kind == 'node' and right.kind == 'node':
+            raise XPathError('Comparing two attributes is not supported.')
+        return compare(left, COMPARE[token.value], right)
+
+    def operand(self):
+        token = self.peek()
+        if token is None:
+            self.fail('a predicate')
+
+        if self.accept('ABBREV', '@'):
+            name = self.accept('NAME')
+            if name is None or name.value == '*' or name.value.endswith(':*'):
+                self.fail('an attribute name')
+            (prefix, lname) = name.value.split(':', 1) if ':' in name.value else (None, name.value)
+            key = (self.resolve(prefix, True), lname)
+            return Operand('node', lambda attrs, position: attrs.get(key), key=key)
+
+        if self.accept('LITERAL'):
+            return Operand('literal', constant(token.value[1:-1]), key=token.value[1:-1])
+
+        if self.accept('NUMBER'):
+            return Operand('number', constant(token.value), key=token.value)
+
+        if self.accept('BRACKET', '('):
+            inner = self.or_expr()
+            self.expect('BRACKET', ')', ')')
+            return Operand('boolean', inner, inner.positional)
+
+        if token.type == 'NAME' and self.peek(1) is not None and self.peek(1).value == '(':
+            self.pos += 2
+            if token.value == 'position':
+                self.expect('BRACKET', ')', ')')
+                return Operand('number', lambda attrs, position: position, True)
+            if token.value == 'not':
+                inner = self.or_expr()
+                self.expect('BRACKET', ')', ')')
+                return Operand('boolean', Predicate(lambda attrs, position: not inner(attrs, position), inner.positional), inner.positional)
+            raise XPathError('The function %s() is not supported.' % token.value)
+
+        raise XPathError('Expected a comparison or a number in a predicate, not %r.' % token.value)
+
+class Predicate(object):
+    """A test of an element's attributes and its position among the
+    candidates for a step.  Position is only counted, and passed,
+    when the predicate is positional.  When the predicate is just an
+    attribute compared to a constant with =, equals is (attribute
+    name, numeric, constant) so that an Index can look it up."""
+
+    __slots__ = ('test', 'positional', 'equals')
+
+    def __init__(self, test, positional=False, equals=None):
+        self.test = test
+        self.positional = positional
+        self.equals = equals
+
+    def __call__(self, attrs, position):
+        return self.test(attrs, position)
+
+class Operand(object):
+    """A node (an attribute), literal, number, or boolean operand of a
+    comparison.  Value is called with (attrs, position); a node's
+    value is None when the attribute is missing.  The key of a node
+    is the attribute's name, and of a literal or number its value."""
+
+    __slots__ = ('kind', 'value', 'positional', 'key')
+
+    def __init__(self, kind, value, positional=False, key=None):
+        self.kind = kind
+        self.value = value
+        self.positional = positional
+        self.key = key
+
+def constant(value):
+    return lambda attrs, position: value
+
+def combine(left, right, reduce):
+    return Predicate(
+        lambda attrs, position: reduce((left(attrs, position), right(attrs, position))),
+        left.positional or right.positional
+    )
+
+COMPARE = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b
+}
+
+def compare(left, op, right):
+    """Compare two operands with XPath 1.0's rules: a missing
+    attribute makes any comparison false; otherwise numbers are
+    compared as numbers, and strings as strings for = and !=."""
+
+    numeric = 'number' in (left.kind, right.kind) or op not in (COMPARE['='], COMPARE['!='])
+    convert = number if numeric else unicode
+    (a, b) = (left.value, right.value)
+
+    def test(attrs, position):
+        x = a(attrs, position); y = b(attrs, position)
+        if x is None or y is None:
+            return False
+        return op(convert(x), convert(y))
+
+    equals = None
+    if op is COMPARE['=']:
+        (node, other) = (left, right) if left.kind == 'node' else (right, left)
+        if node.kind == 'node' and other.kind in ('literal', 'number'):
+            equals = (node.key, numeric, convert(other.key))
+
+    return Predicate(test, left.positional or right.positional, equals)
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        usage()
+    count = 0
+    with open(sys.argv[2], 'rb') as file:
+        for (name, attrs) in select(sys.argv[1], file):
+            print saxns.make_clark_name(name)
+            count += 1
+    print >> sys.stderr, '%d matches' % count
@@ -0,0 +1,149 @@
+"""acceptor -- take connections off a listening socket in batches.
+
+Copyright (c) 2009, Ben Weaver.  All rights reserved.
+This software is issued "as is" under a BSD license
+<http://orangesoda.net/license.html>.  All warranties disclaimed.
+
+When the listening socket becomes readable, an acceptor accepts up to
+batch connections instead of one, so a burst of connects does not sit
+in the kernel's queue for an extra loop iteration per client.  The
+bound keeps a storm from starving connections that are already open;
+the listener is watched level-triggered, so what is left wakes the
+loop again.
+
+Running out of descriptors (EMFILE, ENFILE) would leave the listener
+readable forever.  The acceptor keeps one descriptor in reserve: it
+closes it, accepts and closes the connection at the head of the queue,
+and takes the reserve back.  It then sets resume, and the server stops
+watching the listener until then.
+
+Each wakeup records how many connections were waiting (read from
+TCP_INFO where the platform has it) and how many were accepted.
+
+    >>> import socket
+    >>> sock = socket.socket(); sock.bind(('127.0.0.1', 0)); sock.listen(8)
+    >>> sock.setblocking(0)
+    >>> clients = [socket.create_connection(sock.getsockname()) for _ in range(3)]
+    >>> accept = acceptor(sock, batch=2)
+    >>> len(accept(0.0)), len(accept(0.0)), len(accept(0.0))
+    (2, 1, 0)
+    >>> accept.close()
+"""
+
+import os, errno, socket, struct, logging
+
+__all__ = ('acceptor', 'depth')
+
+log = logging.getLogger('httpd')
+
+## Errors that concern one connection, not the listener.
+TRANSIENT = frozenset((errno.ECONNABORTED, errno.EPROTO, errno.EPERM, errno.ENOBUFS, errno.ENOMEM))
+EXHAUSTED = frozenset((errno.EMFILE, errno.ENFILE))
+
+class acceptor(object):
+
+    def __init__(self, sock, metrics=None, batch=64, pause=0.1):
+        self.sock = sock
+        self.batch = batch
+        self.pause = pause
+
+        ## When not None, the time to start watching the listener
+        ## again after running out of descriptors.
+        self.resume = None
+        self.exhausted = False
+
+        self._reserve = None
+        self._take_reserve()
+
+        (self._batches, self._depth, self._shed) = (None, None, None)
+        if metrics is not None:
+            self._batches = metrics['accept_batch']
+            self._depth = metrics['accept_queue_depth']
+            self._shed = metrics['accept_shed_total']
+
+    def __call__(self, now):
+        """Accept up to batch connections and return their
+        non-blocking sockets."""
+
+        if self._depth is not None:
+            waiting = depth(self.sock)
+            if waiting is not None:
+                self._depth.observe(waiting)
+
+        accepted = []; accept = self.sock.accept
+        for _ in range(self.batch):
+            try:
+                (sock, addr) = accept()
+            except BlockingIOError:
+                break
+            except OSError as exc:
+                if exc.errno in TRANSIENT:
+                    continue
+                if exc.errno not in EXHAUSTED:
+                    raise
+                if not self.exhausted:
+                    log.warning('out of file descriptors; shedding connections')
+                    self.exhausted = True
+                self.shed()
+                self.resume = now + self.pause
+                break
+            sock.setblocking(0)
+            accepted.append(sock)
+
+        if accepted and self.exhausted and self.resume is None:
+            log.warning('accepting connections again')
+            self.exhausted = False
+
+        if self._batches is not None:
+            self._batches.observe(len(accepted))
+        return accepted
+
+    def shed(self):
+        """Out of descriptors: free the reserve to accept the client at
+        the head of the queue and hang up on it, rather than leave it
+        waiting with no answer."""
+
+        if self._reserve is not None:
+            os.close(self._reserve); self._reserve = None
+            try:
+                (sock, addr) = self.sock.accept()
+            except OSError:
+                pass
+            else:
+                sock.close()
+                if self._shed is not None:
+                    self._shed.inc()
+        self._take_reserve()
+
+    def close(self):
+        if self._reserve is not None:
+            os.close(self._reserve); self._reserve = None
+
+    def _take_reserve(self):
+        try:
+            self._reserve = os.open(os.devnull, os.O_RDONLY)
+        except OSError:
+            ## Try again the next time descriptors run out.
+            self._reserve = None
+
+if hasattr(socket, 'TCP_INFO'):
+
+    ## struct tcp_info begins with eight single-byte fields, then
+    ## rto, ato, snd_mss, rcv_mss, and unacked.  On a listening socket
+    ## Linux reports the length of the accept queue in unacked.
+    TCP_INFO = struct.Struct('8xIIIII')
+
+    def depth(sock):
+        """The number of connections waiting to be accepted, or None
+        when it cannot be read."""
+
+        try:
+            info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size)
+        except OSError:
+            return None
+        return TCP_INFO.unpack_from(info)[4] if len(info) >= TCP_INFO.size else None
+
+else:
+
+    def depth(sock):
+        return None
@@ -0,0 +1,327 @@
+"""evio -- buffered non-blocking connections for the event-loop servers.
+
+Copyright (c) 2009, Ben Weaver.  All rights reserved.
+This software is issued "as is" under a BSD license
+<http://orangesoda.net/license.html>.  All warranties disclaimed.
+
+A connection reads into one preallocated bytearray.  The server fills
+it when the socket is readable and then calls handle(conn); the
+handler reads from the buffer with read()/readinto() or takes it all
+at once with consume().
+
+Output is queued.  write() and push() try to send right away; whatever
+the socket does not take waits in the queue, and the server asks for
+write-readiness and calls _flush_output() until it drains.  Several
+buffers are sent with one sendmsg() call without joining them.  Once
+more than high_water bytes are queued, interest() tells the server to
+stop reading from the client until the queue falls below low_water.
+
+A segment of a file can be queued like any other buffer; it is
+streamed with os.sendfile() as the socket becomes writable, so file
+contents never pass through Python.  filecache keeps hot files open.
+"""
+
+import io, os, stat, time, errno, socket, collections, itertools
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+class connection(socket.SocketIO):
+
+    high_water = 256 * 1024
+    low_water = 64 * 1024
+
+    def __init__(self, sock):
+        self._rbuf = bytearray(io.DEFAULT_BUFFER_SIZE)
+        self._wbuf = collections.deque()
+        ## The server's timerwheel.timer, kept across reset().
+        self.timer = None
+        self.reset(sock)
+
+    def reset(self, sock):
+        """Start over with a new socket.  A server can keep closed
+        connections in a pool and reuse them, buffers included."""
+
+        super(connection, self).__init__(sock, 'rwb')
+
+        self._rpos = self._rlen = 0
+        self._wbuf.clear(); self._wlen = 0
+        self.paused = False
+
+        ## Readiness interest the server last registered.
+        self.events = 0
+        ## Per-connection state owned by the handler.
+        self.data = None
+        ## Loop time of the last read or write, used for timeouts.
+        self.active = 0
+        ## Loop time at which the head of an unfinished request began
+        ## to arrive, or 0.  The handler keeps it.
+        self.started = 0
+        self.closing = False
+        ## Byte totals, for the server's statistics.
+        self.received = self.sent = 0
+
+    def readinto(self, b):
+        self._checkClosed()
+        self._checkReadable()
+        return self._readinto_from_buffer(b)
+
+    def consume(self):
+        """Return a view of everything buffered and mark it read.
+        The view is only valid until the buffer is filled again."""
+
+        view = memoryview(self._rbuf)[self._rpos:self._rpos + self._rlen]
+        self._rpos += self._rlen; self._rlen = 0
+        return view
+
+    def write(self, b):
+        self.push(b)
+        return len(b)
+
+    def push(self, *buffers):
+        """Queue bytes-like buffers or segments for output, in order,
+        and start sending them unless earlier output is already
+        waiting for the socket."""
+
+        idle = not self._wbuf
+        for b in buffers:
+            if len(b):
+                self._wbuf.append(b); self._wlen += len(b)
+            elif type(b) is segment:
+                b.close()
+        if idle:
+            self._flush_output()
+        if self._wlen >= self.high_water:
+            self.paused = True
+
+    def interest(self):
+        """Return (read, write): whether the server should wait for
+        this connection to become readable and writable."""
+        return (not (self.closing or self.paused), bool(self._wbuf))
+
+    @property
+    def pending(self):
+        return self._wlen
+
+    @property
+    def idle(self):
+        """True between requests: no output is waiting, and the
+        handler's state (if it has an idle attribute) holds no part of
+        a request.  A draining server closes idle connections."""
+        return not self._wbuf and getattr(self.data, 'idle', True)
+
+    def close_when_done(self):
+        """Ask the server to close this connection once its pending
+        output has been written."""
+        self.closing = True
+
+    def _readinto_from_buffer(self, b):
+        size = min(self._rlen, len(b)); end = self._rpos + size
+        b[0:size] = self._rbuf[self._rpos:end]
+        self._rpos = end; self._rlen -= size
+        return size
+
+    def _fill_buffer(self):
+        """Receive into the buffer.  Return the number of bytes read,
+        0 at end of file, or None if the socket would block."""
+
+        self._rpos = 0
+        try:
+            self._rlen = self._sock.recv_into(self._rbuf)
+        except BlockingIOError:
+            self._rlen = 0
+            return None
+        self.received += self._rlen
+        return self._rlen
+
+    def _flush_output(self):
+        """Send as much queued output as the socket will take.  Return
+        True once the queue is empty."""
+
+        wbuf = self._wbuf
+        while wbuf:
+            head = wbuf[0]
+            try:
+                if type(head) is segment:
+                    sent = head.send(self._sock)
+                elif len(wbuf) == 1:
+                    sent = self._sock.send(head)
+                else:
+                    sent = self._sock.sendmsg(self._gather())
+            except BlockingIOError:
+                break
+            except OSError:
+                ## The peer is gone; nothing queued can be delivered.
+                self._abort()
+                break
+
+            self._wlen -= sent; self.sent += sent
+            if type(head) is segment:
+                if len(head):
+                    break
+                wbuf.popleft().close()
+                continue
+
+            while wbuf and type(wbuf[0]) is not segment and sent >= len(wbuf[0]):
+                sent -= len(wbuf.popleft())
+            if sent:
+                ## A short write means the socket buffer is full.
+                wbuf[0] = memoryview(wbuf[0])[sent:]
+                break
+
+        if self.paused and self._wlen <= self.low_water:
+            self.paused = False
+        return not wbuf
+
+    def _gather(self):
+        """The buffers that lead the queue, up to the first segment."""
+        for b in itertools.islice(self._wbuf, IOV_MAX):
+            if type(b) is segment:
+                break
+            yield b
+
+    def _abort(self):
+        self._discard_output()
+        self.closing = True
+
+    def _discard_output(self):
+        for b in self._wbuf:
+            if type(b) is segment:
+                b.close()
+        self._wbuf.clear(); self._wlen = 0
+        self.paused = False
+
+    def getsockopt(self, *args):
+        return self._sock.getsockopt(*args)
+
+    def close(self):
+        self._discard_output()
+        ## The handler's state goes with the connection; work still
+        ## in progress for it can tell that it is gone.
+        self.data = None
+        return self._sock.close()
+
+
+### Files
+
+class segment(object):
+    """A byte range of a file to be sent with os.sendfile().  The
+    file is anything with fileno() and close(); it is closed once the
+    segment has been sent or discarded."""
+
+    def __init__(self, file, offset=0, count=None):
+        self.file = file
+        self.offset = offset
+        self.count = os.fstat(file.fileno()).st_size - offset if count is None else count
+
+    def __repr__(self):
+        return '<%s %r %d+%d>' % (type(self).__name__, self.file, self.offset, self.count)
+
+    def __len__(self):
+        return self.count
+
+    def send(self, sock):
+        if sendfile is None:
+            data = os.pread(self.file.fileno(), min(self.count, 256 * 1024), self.offset)
+            sent = sock.send(data) if data else 0
+        else:
+            sent = sendfile(sock.fileno(), self.file.fileno(), self.offset, self.count)
+        if not sent and self.count:
+            raise OSError(errno.EIO, 'File ended before the segment was sent.')
+        self.offset += sent; self.count -= sent
+        return sent
+
+    def close(self):
+        if self.file is not None:
+            (file, self.file) = (self.file, None)
+            file.close()
+
+sendfile = getattr(os, 'sendfile', None)
+
+class filecache(object):
+    """Keep up to size files open along with their stat results.  A
+    cached stat is trusted for ttl seconds; after that it is checked
+    against the file system and the file is reopened if it changed.
+
+    open() returns a cachedfile holding a reference for the caller,
+    who must close() it (usually by handing it to a segment)."""
+
+    def __init__(self, size=64, ttl=1.0):
+        self.size = size
+        self.ttl = ttl
+
+        self.hits = self.misses = 0
+        self._files = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._files)
+
+    def open(self, path):
+        now = time.monotonic()
+        entry = self._files.get(path)
+
+        if entry is not None and now - entry.checked >= self.ttl:
+            try:
+                fresh = entry.same(os.stat(path))
+            except OSError:
+                self.evict(path)
+                raise
+            if fresh:
+                entry.checked = now
+            else:
+                self.evict(path)
+                entry = None
+
+        if entry is not None:
+            self.hits += 1
+            self._files.move_to_end(path)
+            entry.refs += 1
+            return entry
+
+        self.misses += 1
+        entry = self._files[path] = cachedfile(path, now)
+        while len(self._files) > self.size:
+            self.evict(next(iter(self._files)))
+        entry.refs += 1
+        return entry
+
+    def evict(self, path):
+        self._files.pop(path).close()
+
+    def clear(self):
+        while self._files:
+            self.evict(next(iter(self._files)))
+
+class cachedfile(object):
+    """An open, regular file shared by every response that sends it.
+    The cache holds one reference; the descriptor is closed when the
+    last reference is closed."""
+
+    def __init__(self, path, checked):
+        self.path = path
+        self.checked = checked
+
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+        self.stat = os.fstat(self.fd)
+        if not stat.S_ISREG(self.stat.st_mode):
+            os.close(self.fd)
+            raise IsADirectoryError(errno.EISDIR, 'Not a regular file', path)
+        self.refs = 1
+
+    def __repr__(self):
+        return '<%s %r refs=%d>' % (type(self).__name__, self.path, self.refs)
+
+    def fileno(self):
+        return self.fd
+
+    def same(self, st):
+        old = self.stat
+        return (st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns) == \
+            (old.st_ino, old.st_dev, old.st_size, old.st_mtime_ns)
+
+    def close(self):
+        self.refs -= 1
+        if not self.refs:
+            os.close(self.fd)
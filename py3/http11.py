@@ -0,0 +1,532 @@
+"""http11 -- an incremental HTTP/1.1 request parser for the event-loop
+servers.
+
+Copyright (c) 2009, Ben Weaver.  All rights reserved.
+This software is issued "as is" under a BSD license
+<http://orangesoda.net/license.html>.  All warranties disclaimed.
+
+handler(app) adapts an application, a callable that takes a request
+and returns a response, to the handle(conn) contract of the servers.
+Bytes are fed to a per-connection parser as they arrive; every
+complete request is answered in order, so pipelined requests that
+arrive in one read get one reply each.  Connections stay open unless
+the client asks for "Connection: close" (or speaks HTTP/1.0 without
+"Connection: keep-alive").
+
+    >>> p = parser()
+    >>> [r.target for r in p.feed(b'GET /a HTTP/1.1\\r\\nHost: x\\r\\n\\r\\nGET /b HT')]
+    ['/a']
+    >>> [r.target for r in p.feed(b'TP/1.1\\r\\nConnection: close\\r\\n\\r\\n')]
+    ['/b']
+
+static(root) is an application that serves files.  Responses carry an
+evio.segment as their body and are streamed with os.sendfile(); single
+byte ranges are honored.
+"""
+
+import os, time, logging, functools, collections, mimetypes, urllib.parse
+import evio, offload
+
+log = logging.getLogger('httpd')
+
+__all__ = ('HTTPError', 'request', 'response', 'parser', 'handler', 'static')
+
+MAX_HEAD = 64 * 1024
+MAX_BODY = 16 * 1024 * 1024
+
+REASONS = {
+    100: 'Continue',
+    200: 'OK',
+    206: 'Partial Content',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    416: 'Range Not Satisfiable',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+    503: 'Service Unavailable',
+    505: 'HTTP Version Not Supported'
+}
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message=None):
+        super(HTTPError, self).__init__(message or REASONS.get(status, 'Error'))
+        self.status = status
+
+
+### Messages
+
+class request(object):
+
+    def __init__(self, method, target, version, headers, body=b''):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def __repr__(self):
+        return '<%s %s %s>' % (type(self).__name__, self.method, self.target)
+
+    def header(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    @property
+    def keep_alive(self):
+        tokens = self.header('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in tokens
+        return 'close' not in tokens
+
+class response(object):
+
+    def __init__(self, status=200, headers=(), body=b''):
+        self.status = status
+        self.headers = list(headers)
+        self.body = body
+
+    def __repr__(self):
+        return '<%s %d>' % (type(self).__name__, self.status)
+
+    def head(self, req=None, keep_alive=True):
+        lines = ['HTTP/1.1 %d %s' % (self.status, REASONS.get(self.status, 'Unknown'))]
+        lines.extend('%s: %s' % item for item in self.headers)
+        lines.append('Content-Length: %d' % len(self.body))
+        if not keep_alive:
+            lines.append('Connection: close')
+        elif req is not None and req.version == 'HTTP/1.0':
+            lines.append('Connection: keep-alive')
+        lines.append('\r\n')
+        return '\r\n'.join(lines).encode('latin-1')
+
+    def buffers(self, req=None, keep_alive=True):
+        """The head and body as separate buffers, for scatter/gather
+        output."""
+
+        head = self.head(req, keep_alive)
+        if req is not None and req.method == 'HEAD':
+            if type(self.body) is evio.segment:
+                self.body.close()
+            return (head,)
+        return (head, self.body)
+
+def error(exc):
+    return response(exc.status, [('Content-Type', 'text/plain')], str(exc).encode('utf-8'))
+
+
+### Parser
+
+class parser(object):
+    """Parse requests out of a byte stream.  feed() returns the list
+    of requests completed by the new data; a partial request is kept
+    until the rest of it arrives.
+
+    Bad data raises HTTPError.  The requests completed before it in
+    the same data are put on queue first, so they can still be
+    answered; the error is kept in error and later data is ignored.
+
+    >>> p = parser(max_body=16)
+    >>> p.feed(b'GET /a HTTP/1.1\\r\\n\\r\\nPOST /b HTTP/1.1\\r\\n'
+    ...        b'Transfer-Encoding: chunked\\r\\n\\r\\nFFFFFFFF\\r\\n')
+    Traceback (most recent call last):
+      ...
+    http11.HTTPError: Payload Too Large
+    >>> (list(p.queue), p.error.status)
+    ([<request GET /a>], 413)
+    """
+
+    def __init__(self, max_head=MAX_HEAD, max_body=MAX_BODY):
+        self.max_head = max_head
+        self.max_body = max_body
+
+        ## Requests parsed but not answered yet.
+        self.queue = collections.deque()
+        ## True while a request is out on an offload pool.
+        self.busy = False
+
+        ## The HTTPError that ended the stream, if any.
+        self.error = None
+
+        self._buf = bytearray()
+        self._req = None
+        self._need = 0
+        self._chunk = None
+
+    @property
+    def partial(self):
+        """True while the head of a request is partly received."""
+        return self._req is None and bool(self._buf)
+
+    @property
+    def idle(self):
+        """True when no request is partly received or unanswered."""
+        return self._req is None and not self._buf and not self.queue and not self.busy
+
+    def feed(self, data):
+        if self.error is not None:
+            return []
+        self._buf += data
+        requests = []
+        try:
+            while self._buf:
+                req = self._next()
+                if req is None:
+                    break
+                requests.append(req)
+        except HTTPError as exc:
+            self.error = exc
+            self.queue.extend(requests)
+            del self._buf[:]; self._req = None
+            raise
+        return requests
+
+    def _next(self):
+        buf = self._buf
+
+        if self._req is None:
+            ## Clients may send stray CRLFs between requests.
+            while buf[:2] == b'\r\n':
+                del buf[:2]
+            end = buf.find(b'\r\n\r\n')
+            if end < 0:
+                if len(buf) > self.max_head:
+                    raise HTTPError(431)
+                return None
+            self._req = self._head(bytes(buf[:end]))
+            del buf[:end + 4]
+
+        if self._chunk is not None:
+            if not self._chunks():
+                return None
+        elif len(buf) < self._need:
+            return None
+        else:
+            self._req.body = bytes(buf[:self._need])
+            del buf[:self._need]
+
+        (req, self._req, self._need) = (self._req, None, 0)
+        return req
+
+    def _head(self, head):
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            (method, target, version) = lines[0].split(' ')
+        except ValueError:
+            raise HTTPError(400, 'Malformed request line.')
+        if not version.startswith('HTTP/1.'):
+            raise HTTPError(505)
+
+        headers = {}
+        for line in lines[1:]:
+            (name, sep, value) = line.partition(':')
+            if not sep or not name or name[0] in ' \t':
+                raise HTTPError(400, 'Malformed header: %r.' % line)
+            name = name.strip().lower(); value = value.strip()
+            headers[name] = ('%s, %s' % (headers[name], value)) if name in headers else value
+
+        req = request(method, target, version, headers)
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            self._chunk = -1
+            req.body = bytearray()
+        elif 'content-length' in headers:
+            self._need = decimal(headers['content-length'])
+            if self._need is None:
+                raise HTTPError(400, 'Bad Content-Length.')
+            if self._need > self.max_body:
+                raise HTTPError(413)
+        return req
+
+    def _chunks(self):
+        """Decode as much of a chunked body as is buffered.  The chunk
+        state is -1 when a size line is expected, -2 while reading
+        trailers, and otherwise the size of the current chunk."""
+
+        buf = self._buf; body = self._req.body
+        while True:
+            if self._chunk >= 0:
+                if len(buf) < self._chunk + 2:
+                    return False
+                if buf[self._chunk:self._chunk + 2] != b'\r\n':
+                    raise HTTPError(400, 'Bad chunk.')
+                body += buf[:self._chunk]
+                del buf[:self._chunk + 2]
+                self._chunk = -1
+                continue
+
+            end = buf.find(b'\r\n')
+            if end < 0:
+                if len(buf) > self.max_head:
+                    raise HTTPError(400, 'Chunk line too long.')
+                return False
+            line = bytes(buf[:end]); del buf[:end + 2]
+
+            if self._chunk == -2:
+                if not line:
+                    self._chunk = None
+                    self._req.body = bytes(body)
+                    return True
+            else:
+                ## int() would also take a sign, underscores, and
+                ## spaces; a chunk size is only hex digits.
+                digits = line.split(b';', 1)[0].rstrip(b' \t')
+                if not digits or digits.strip(HEX):
+                    raise HTTPError(400, 'Bad chunk size.')
+                size = int(digits, 16)
+                if len(body) + size > self.max_body:
+                    raise HTTPError(413)
+                self._chunk = size if size else -2
+
+HEX = b'0123456789abcdefABCDEF'
+
+def decimal(text):
+    """Parse a length that is only ASCII digits, or return None.
+    int() would also take a sign, underscores, surrounding spaces,
+    and the digits of other scripts, and a proxy in front that does
+    not would frame the message differently.
+
+    >>> decimal('10'), decimal('+5'), decimal(' 5'), decimal('1_0'), decimal('')
+    (10, None, None, None, None)
+    """
+    return int(text) if text.isascii() and text.isdigit() else None
+
+
+### Handler
+
+def handler(app, stats=None, pool=None):
+    """Adapt app(request) -> response to the handle(conn) contract.
+    The parser for each connection is kept in conn.data, and
+    conn.started records when an unfinished request head began to
+    arrive, for the server's header timeout.  Given a
+    stats.registry, requests are counted and the time app takes for
+    each one is recorded.
+
+    Given an offload.pool, app runs on the pool's threads.  Each
+    connection has one request there at a time, so responses stay in
+    order; the server calls pool.collect() when the pool wakes it and
+    updates the connections it returns.  A full pool is answered with
+    503."""
+
+    requests = seconds = None
+    if stats is not None:
+        (requests, seconds) = (stats['requests_total'], stats['request_seconds'])
+        if pool is None:
+            app = timed(app, requests, seconds)
+
+    def handle(conn):
+        http = conn.data
+        if http is None:
+            http = conn.data = parser()
+
+        if conn.closing:
+            ## A previous request asked to close; ignore the rest.
+            conn.consume()
+            return
+
+        try:
+            received = http.feed(conn.consume())
+        except HTTPError:
+            ## The requests before the bad data were queued; answer
+            ## them, then the error.
+            received = []
+
+        http.queue.extend(received)
+        if not http.partial:
+            conn.started = 0
+        elif received or not conn.started:
+            conn.started = conn.active
+
+        ## Stop answering once the client falls behind; the server
+        ## calls handle() again when its output queue drains.
+        out = []; size = 0; queue = http.queue
+        while queue and not conn.paused and not http.busy:
+            req = queue.popleft()
+            if pool is None:
+                try:
+                    resp = app(req)
+                except HTTPError as exc:
+                    resp = error(exc)
+            else:
+                try:
+                    pool.submit(run, req, functools.partial(done, conn, http, req))
+                except offload.Overloaded:
+                    resp = error(HTTPError(503, 'Too many requests in progress.'))
+                    resp.headers.append(('Retry-After', '1'))
+                else:
+                    http.busy = True
+                    break
+            size += answer(conn, http, req, resp, out)
+            if size >= conn.low_water or len(out) >= 64:
+                conn.push(*out); out = []; size = 0
+
+        if out:
+            conn.push(*out)
+
+        if http.error is not None and not queue and not http.busy and not conn.closing:
+            conn.push(*error(http.error).buffers(keep_alive=False))
+            conn.close_when_done()
+
+    def run(req):
+        ## On a pool thread.
+        start = time.perf_counter()
+        try:
+            resp = app(req)
+        except HTTPError as exc:
+            resp = error(exc)
+        return (resp, time.perf_counter() - start)
+
+    def done(conn, http, req, future):
+        ## Back on the loop thread.
+        http.busy = False
+        try:
+            (resp, elapsed) = future.result()
+        except Exception:
+            log.exception('%s %s failed', req.method, req.target)
+            (resp, elapsed) = (error(HTTPError(500)), None)
+
+        if conn.data is not http:
+            ## The connection closed while app was running.
+            if type(resp.body) is evio.segment:
+                resp.body.close()
+            return None
+
+        if requests is not None:
+            requests.inc()
+            if elapsed is not None:
+                seconds.observe(elapsed)
+
+        out = []
+        answer(conn, http, req, resp, out)
+        conn.push(*out)
+        handle(conn)
+        return conn
+
+    return handle
+
+def answer(conn, http, req, resp, out):
+    """Add the buffers of the response to req to out and return
+    their size."""
+
+    keep_alive = req.keep_alive
+    size = 0
+    for b in resp.buffers(req, keep_alive):
+        out.append(b); size += len(b)
+    if not keep_alive:
+        http.queue.clear()
+        conn.close_when_done()
+    return size
+
+def timed(app, requests, seconds):
+    clock = time.perf_counter
+
+    def app_timed(req):
+        start = clock()
+        try:
+            return app(req)
+        finally:
+            seconds.observe(clock() - start)
+            requests.inc()
+
+    return app_timed
+
+
+### Files
+
+def static(root, cache=None):
+    """An application that serves the regular files under root.  Open
+    descriptors and stat results are kept in an evio.filecache."""
+
+    root = os.path.abspath(root)
+    cache = evio.filecache() if cache is None else cache
+
+    def app(req):
+        if req.method not in ('GET', 'HEAD'):
+            raise HTTPError(405)
+
+        path = urllib.parse.unquote(req.target.split('?', 1)[0])
+        path = os.path.join(root, os.path.normpath('/' + path).lstrip('/'))
+        try:
+            file = cache.open(path)
+        except (OSError, ValueError):
+            raise HTTPError(404)
+
+        return send_file(req, file, mimetypes.guess_type(path)[0])
+
+    app.cache = cache
+    return app
+
+def send_file(req, file, content_type=None):
+    """Make a response that sends file (an evio.cachedfile or any
+    object with fileno(), close() and a stat attribute), honoring a
+    Range header."""
+
+    size = file.stat.st_size
+    headers = [
+        ('Content-Type', content_type or 'application/octet-stream'),
+        ('Accept-Ranges', 'bytes')
+    ]
+
+    try:
+        span = byte_range(req.header('range'), size)
+    except HTTPError:
+        file.close()
+        headers.append(('Content-Range', 'bytes */%d' % size))
+        return response(416, headers)
+
+    if span is None:
+        return response(200, headers, evio.segment(file, 0, size))
+
+    (start, end) = span
+    headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, size)))
+    return response(206, headers, evio.segment(file, start, end - start + 1))
+
+def byte_range(header, size):
+    """Parse a Range header into an inclusive (start, end) for a file
+    of the given size.  Return None when the whole file should be
+    sent: no header, another unit, several ranges, or bad syntax.
+    Raise HTTPError(416) when the range cannot be satisfied.
+
+    >>> byte_range('bytes=0-99', 1000), byte_range('bytes=900-', 1000)
+    ((0, 99), (900, 999))
+    >>> byte_range('bytes=-100', 1000), byte_range('bytes=10-5000', 1000)
+    ((900, 999), (10, 999))
+    >>> byte_range('bytes=0-1,5-6', 1000), byte_range('pages=1-2', 1000)
+    (None, None)
+    >>> byte_range('bytes=+0-99', 1000), byte_range('bytes=0-1_0', 1000)
+    (None, None)
+    >>> byte_range('bytes=1000-', 1000)
+    Traceback (most recent call last):
+      ...
+    http11.HTTPError: Range Not Satisfiable
+    """
+
+    if not header:
+        return None
+    (unit, _, spec) = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    (first, dash, last) = spec.strip().partition('-')
+    if not dash:
+        return None
+    elif not first:
+        suffix = decimal(last)
+        if suffix is None:
+            return None
+        if suffix <= 0 or not size:
+            raise HTTPError(416)
+        return (max(0, size - suffix), size - 1)
+
+    start = decimal(first)
+    end = decimal(last) if last else size - 1
+    if start is None or end is None:
+        return None
+
+    if last and start > end:
+        return None
+    if start >= size:
+        raise HTTPError(416)
+    return (start, min(end, size - 1))
@@ -0,0 +1,372 @@
+"""httpbench -- load-test the event-loop web servers.
+
+Copyright (c) 2009, Ben Weaver.  All rights reserved.
+This software is issued "as is" under a BSD license
+<http://orangesoda.net/license.html>.  All warranties disclaimed.
+
+Each server -- every readiness backend of httpd-kqueue.py, the pyev
+server, and the asyncio server on the default loop and on uvloop --
+is started in a subprocess on a free localhost port.  Client
+processes each open some connections and keep them busy: a
+connection sends a batch of pipelined requests, waits for all of the
+responses, and sends the next batch.  Without --keep-alive every
+request is HTTP/1.0 on a new connection.  Servers whose dependencies
+are missing are skipped.
+
+The latency of a request is the time from sending its batch to
+reading the end of its response.  The result is a table of requests
+per second and latency percentiles in milliseconds:
+
+    > python3 httpbench.py --duration 2 --clients 2 --connections 8 --keep-alive --pipeline 4
+    server         requests     req/s  errors    p50 ms    p99 ms   p999 ms
+    epoll            176532   88266.0       0     0.660     2.241     3.061
+    poll             178176   89088.0       0     0.716     1.266     2.333
+    asyncio          184376   92188.0       0     0.682     1.256     2.197
+    uvloop           196044   98022.0       0     0.637     1.230     2.141
+
+With --json the results are also written to a file along with the
+options and the git commit of the tree, and --baseline compares a run
+against such a file.  Only loopback addresses are accepted; this is
+not a tool for loading other people's servers.
+"""
+
+import sys, os, json, math, time, array, socket, platform, selectors, ipaddress
+import subprocess, collections, multiprocessing, argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+REQUEST = b'GET / HTTP/1.0\r\nHost: localhost\r\n\r\n'
+KEEP_ALIVE = b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+
+PERCENTILES = (('p50', 50.0), ('p99', 99.0), ('p999', 99.9))
+
+def free_port(addr='127.0.0.1'):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((addr, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+def spawn(script, port, *args, addr='127.0.0.1', timeout=5.0):
+    """Start a server script in a subprocess and wait until it
+    accepts connections."""
+
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, script), '--addr', addr, '--port', str(port)] + list(args),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('%s exited with status %d.' % (script, proc.returncode))
+        try:
+            socket.create_connection((addr, port), 0.1).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+
+    proc.kill()
+    raise RuntimeError('%s did not start listening on port %d.' % (script, port))
+
+def stop(proc):
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+### Client
+
+class session(object):
+    """One client connection.  It sends depth requests at a time and
+    records the latency of each response as it completes.  Without
+    keep-alive it reconnects for every request."""
+
+    def __init__(self, sel, addr, port, keep_alive=False, depth=1):
+        self.sel = sel
+        self.addr = (addr, port)
+        self.keep_alive = keep_alive
+        self.depth = depth if keep_alive else 1
+        self.batch = (KEEP_ALIVE if keep_alive else REQUEST) * self.depth
+
+        self.sock = None
+        self.buf = bytearray()
+        self.sent = collections.deque()
+
+    def connect(self):
+        self.sock = socket.create_connection(self.addr)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sel.register(self.sock, selectors.EVENT_READ, self)
+        self.send()
+
+    def send(self):
+        ## A batch is far smaller than the socket buffer, so sending
+        ## it on the blocking socket does not stall the other sessions.
+        self.sent.extend([time.monotonic()] * self.depth)
+        self.sock.sendall(self.batch)
+
+    def readable(self, latencies):
+        data = self.sock.recv(64 * 1024)
+        if not data:
+            raise ConnectionError('Connection closed with %d responses outstanding.' % len(self.sent))
+        self.buf += data
+
+        now = time.monotonic()
+        while self.sent:
+            end = response_end(self.buf)
+            if end is None:
+                break
+            del self.buf[:end]
+            latencies.append(now - self.sent.popleft())
+
+        if not self.sent:
+            if self.keep_alive:
+                self.send()
+            else:
+                self.close()
+                self.connect()
+
+    def close(self):
+        if self.sock is not None:
+            self.sel.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
+        del self.buf[:]
+        self.sent.clear()
+
+def response_end(buf):
+    """Return the offset just past the first complete response in
+    buf, or None if it has not all arrived.
+
+    >>> response_end(b'HTTP/1.1 200 OK\\r\\nContent-Length: 2\\r\\n\\r\\nhiHTTP/1.1')
+    40
+    >>> response_end(b'HTTP/1.1 200 OK\\r\\nContent-Length: 2\\r\\n\\r\\nh') is None
+    True
+    """
+
+    end = buf.find(b'\r\n\r\n')
+    if end < 0:
+        return None
+    end += 4 + content_length(bytes(buf[:end]))
+    return end if len(buf) >= end else None
+
+def content_length(head):
+    for line in head.split(b'\r\n')[1:]:
+        (name, _, value) = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            return int(value)
+    return 0
+
+def hammer(addr, port, duration, connections=1, keep_alive=False, depth=1):
+    """Keep connections sessions busy for duration seconds.  Return
+    an array of latencies in seconds and the number of errors; a
+    session that fails is counted and reconnected."""
+
+    sel = selectors.DefaultSelector()
+    latencies = array.array('d'); errors = 0
+
+    sessions = [session(sel, addr, port, keep_alive, depth) for _ in range(connections)]
+    deadline = time.monotonic() + duration
+    try:
+        pending = list(sessions)
+        while time.monotonic() < deadline:
+            (waiting, pending) = (pending, [])
+            for s in waiting:
+                try:
+                    s.connect()
+                except OSError:
+                    errors += 1
+                    s.close()
+                    pending.append(s)
+
+            ## Retry failed connections soon, not at the deadline.
+            timeout = max(0, deadline - time.monotonic())
+            for (key, mask) in sel.select(min(timeout, 0.05) if pending else timeout):
+                s = key.data
+                try:
+                    s.readable(latencies)
+                except OSError:
+                    errors += 1
+                    s.close()
+                    pending.append(s)
+    finally:
+        for s in sessions:
+            s.close()
+        sel.close()
+
+    return (latencies, errors)
+
+def measure(addr, port, duration, clients, connections=1, keep_alive=False, depth=1):
+    """Run clients processes of hammer() and merge their results
+    into a summary."""
+
+    args = (addr, port, duration, connections, keep_alive, depth)
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.starmap(hammer, [args] * clients)
+
+    latencies = array.array('d'); errors = 0
+    for (lat, err) in results:
+        latencies.extend(lat); errors += err
+    return summarize(latencies, errors, duration)
+
+def summarize(latencies, errors, duration):
+    """Reduce latencies (in seconds) to a summary with milliseconds.
+
+    >>> s = summarize([i / 1000.0 for i in range(1, 1001)], 0, 2.0)
+    >>> s['requests'], s['rps'], s['p50'], s['p99'], s['p999']
+    (1000, 500.0, 500.0, 990.0, 999.0)
+    """
+
+    ordered = sorted(latencies)
+    summary = dict(
+        requests=len(ordered),
+        errors=errors,
+        rps=len(ordered) / duration,
+        mean=1000.0 * sum(ordered) / len(ordered) if ordered else None,
+        max=1000.0 * ordered[-1] if ordered else None
+    )
+    for (name, q) in PERCENTILES:
+        summary[name] = percentile(ordered, q)
+    return summary
+
+def percentile(ordered, q):
+    """The nearest-rank percentile of sorted latencies, in ms."""
+    if not ordered:
+        return None
+    rank = math.ceil(q * len(ordered) / 100.0 - 1e-9)
+    return round(1000.0 * ordered[min(max(rank, 1), len(ordered)) - 1], 6)
+
+
+### Servers
+
+def servers():
+    """Map the name of each runnable server to its script and
+    arguments."""
+
+    import select, importlib.util
+
+    found = {}
+    for name in ('kqueue', 'epoll', 'poll'):
+        if hasattr(select, name):
+            found[name] = ('httpd-kqueue.py', ['--backend', name])
+    if importlib.util.find_spec('pyev'):
+        found['pyev'] = ('httpd-pyev.py', [])
+    found['asyncio'] = ('httpd-asyncio.py', [])
+    if importlib.util.find_spec('uvloop'):
+        found['uvloop'] = ('httpd-asyncio.py', ['--uvloop'])
+    return found
+
+def compare(names, duration=5.0, clients=4, connections=1, keep_alive=False, depth=1, addr='127.0.0.1'):
+    """Benchmark each named server in turn; return a list of
+    summaries, each with the server's name."""
+
+    available = servers()
+    results = []
+    for name in names:
+        (script, args) = available[name]
+        port = free_port(addr)
+        proc = spawn(script, port, *args, addr=addr)
+        try:
+            summary = measure(addr, port, duration, clients, connections, keep_alive, depth)
+        finally:
+            stop(proc)
+        summary['server'] = name
+        results.append(summary)
+    return results
+
+
+### Reports
+
+def commit():
+    """The git commit of this tree, marked if it has local changes."""
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE, stderr=subprocess.DEVNULL)
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--', '.'], cwd=HERE, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return rev.decode('ascii').strip() + ('-dirty' if dirty else '')
+
+def report(results, options):
+    return dict(
+        commit=commit(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=multiprocessing.cpu_count(),
+        options=options,
+        results=results
+    )
+
+def table(results, baseline=None):
+    """Print results, with the change from a baseline report (a dict
+    loaded from --json output) when one is given."""
+
+    old = dict((r['server'], r) for r in baseline['results']) if baseline else {}
+
+    columns = ('rps',) + tuple(name for (name, _) in PERCENTILES)
+    print('%-10s %12s %9s %7s %9s %9s %9s' % ('server', 'requests', 'req/s', 'errors', 'p50 ms', 'p99 ms', 'p999 ms'))
+    for r in results:
+        print('%-10s %12d %9.1f %7d' % (r['server'], r['requests'], r['rps'], r['errors'])
+              + ''.join(' %9s' % fmt(r[c]) for c in columns[1:]))
+        if r['server'] in old:
+            prev = old[r['server']]
+            print('%-10s %12s %9s %7s' % ('', '', change(prev['rps'], r['rps']), '')
+                  + ''.join(' %9s' % change(prev[c], r[c]) for c in columns[1:]))
+
+def fmt(value):
+    return '-' if value is None else '%.3f' % value
+
+def change(old, new):
+    if not old or new is None:
+        return '-'
+    return '%+.1f%%' % (100.0 * (new - old) / old)
+
+def loopback(addr):
+    if not ipaddress.ip_address(addr).is_loopback:
+        raise argparse.ArgumentTypeError('%s is not a loopback address.' % addr)
+    return addr
+
+def main(argv=None):
+    available = servers()
+
+    parser = argparse.ArgumentParser(description='Load-test web servers on localhost.')
+    parser.add_argument('--addr', type=loopback, default='127.0.0.1')
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--clients', type=int, default=multiprocessing.cpu_count(), help='client processes')
+    parser.add_argument('--connections', type=int, default=1, help='concurrent connections per client')
+    parser.add_argument('--keep-alive', action='store_true', help='reuse connections for HTTP/1.1 requests')
+    parser.add_argument('--pipeline', type=int, default=1, help='requests in flight per keep-alive connection')
+    parser.add_argument('--server', '--backend', action='append', dest='servers', choices=list(available))
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with results written by --json')
+    opts = parser.parse_args(argv)
+
+    if opts.pipeline > 1 and not opts.keep_alive:
+        parser.error('--pipeline needs --keep-alive')
+
+    baseline = None
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+
+    results = compare(
+        opts.servers or list(available), opts.duration, opts.clients,
+        opts.connections, opts.keep_alive, opts.pipeline, opts.addr
+    )
+    table(results, baseline)
+
+    if opts.json:
+        options = dict(
+            duration=opts.duration, clients=opts.clients, connections=opts.connections,
+            keep_alive=opts.keep_alive, pipeline=opts.pipeline
+        )
+        with open(opts.json, 'w') as f:
+            json.dump(report(results, options), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
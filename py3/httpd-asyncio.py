@@ -0,0 +1,477 @@
+"""httpd-asyncio -- A "hello world" web server implemented using asyncio.
+
+Copyright (c) 2009, Ben Weaver.  All rights reserved.
+This software is issued "as is" under a BSD license
+<http://orangesoda.net/license.html>.  All warranties disclaimed.
+
+The same handle(conn) contract as httpd-kqueue.py and httpd-pyev.py,
+driven by a standard event loop.  The protocol is a BufferedProtocol:
+the transport receives straight into the connection's preallocated
+bytearray, as evio.connection does, and the handler consumes it from
+there.  With --uvloop the server runs on uvloop instead of the
+default loop.  With --threads, the application runs on a thread pool
+(see offload.py) whose wakeup socket the loop watches.  The loop
+accepts connections itself, in batches, and backs off when descriptors
+run out; the server only records the accept queue depth.
+
+The idle, header and write timeouts are those of the other servers,
+checked by a sweep every sweep_interval seconds rather than by a
+timer wheel.  Output counts as progress once the transport has passed
+it to the socket, and files go to loop.sendfile() in pieces so that a
+slow client receiving a large one is not taken for a stalled one.
+"""
+
+import io, os, sys, socket, signal, asyncio, logging, argparse
+import prefork, evio, http11, stats, offload, acceptor
+
+log = logging.getLogger('httpd')
+sample = stats.sampler(log, 1000)
+
+def hello(request):
+    sample('%s %s', request.method, request.target)
+    return http11.response(200, [('Content-Type', 'text/plain')], b'Hello, world!')
+
+handle = http11.handler(hello)
+
+class server(object):
+
+    ## How often to measure how late the loop runs a callback.
+    lag_interval = 0.1
+    ## How often to look for connections past their deadline.
+    sweep_interval = 0.5
+
+    def __init__(self, handle, idle=30.0, uvloop=False, metrics=None, drain=10.0, offload=None, header_timeout=10.0, write_timeout=30.0):
+        self.handle = handle
+        self.offload = offload
+        self.idle = idle
+        self.header_timeout = header_timeout
+        self.write_timeout = write_timeout
+        self.uvloop = uvloop
+        self.drain_timeout = drain
+        self.metrics = stats.server() if metrics is None else metrics
+        self.metrics.connections = lambda: (p.conn for p in self.clients)
+        self.metrics.histogram('loop_lag_seconds', 'How late the loop ran a scheduled callback.')
+
+    def __call__(self, addr='127.0.0.1', port=8080, backlog=None, workers=None, stats_port=None):
+        if workers:
+            ## Each worker binds its own socket and the kernel
+            ## balances new connections between them.  The stats
+            ## port is shared the same way, so each scrape reports
+            ## on one worker.
+            prefork.supervisor(self.run, workers, grace=self.drain_timeout + 1)(
+                addr, port, backlog, stats_port, reuseport=True
+            )
+        else:
+            self.run(addr, port, backlog, stats_port)
+
+    def run(self, addr, port, backlog=None, stats_port=None, reuseport=False):
+        ## After a reload, carry on with the previous process's
+        ## sockets.
+        sock = prefork.inherited('listen') or self.listen(addr, port, backlog, reuseport)
+        side = prefork.inherited('stats')
+        if side is None and stats_port:
+            side = stats.listen(addr, stats_port, reuseport)
+        try:
+            self.serve(sock, side)
+        finally:
+            sock.close()
+            if side is not None:
+                side.close()
+
+    def listen(self, addr, port, backlog=None, reuseport=False):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((addr, port))
+        sock.listen(socket.SOMAXCONN if backlog is None else backlog)
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return sock
+
+    def serve(self, sock, side=None):
+        if self.uvloop:
+            import uvloop
+            loop = uvloop.new_event_loop()
+        else:
+            loop = asyncio.new_event_loop()
+
+        try:
+            loop.run_until_complete(self.main(loop, sock, side))
+        finally:
+            loop.close()
+
+    async def main(self, loop, sock, side=None):
+        self.loop = loop
+        self.clients = set()
+        self.stopped = loop.create_future()
+        self.draining = False
+        self.sock = sock; self.side = side
+
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            loop.add_signal_handler(signum, self.signalled, signum)
+        if side is not None:
+            loop.add_reader(side.fileno(), stats.serve, side, self.metrics)
+        if self.offload is not None:
+            loop.add_reader(self.offload.fileno(), self.collect)
+
+        srv = self.srv = await loop.create_server(lambda: protocol(self), sock=sock)
+        self.sweep = loop.call_later(self.sweep_interval, self.expire)
+        probe = loop.call_later(self.lag_interval, self.lag, loop.time() + self.lag_interval)
+        try:
+            await self.stopped
+        finally:
+            self.sweep.cancel()
+            probe.cancel()
+            if self.offload is not None:
+                loop.remove_reader(self.offload.fileno())
+            if side is not None and not self.draining:
+                loop.remove_reader(side.fileno())
+            srv.close()
+            for proto in list(self.clients):
+                proto.transport.abort()
+            await srv.wait_closed()
+
+    def signalled(self, signum):
+        """SIGINT and SIGTERM start draining, and a second SIGINT stops
+        at once.  SIGHUP starts a new process with the same sockets and
+        drains this one."""
+
+        if signum == signal.SIGHUP and not self.draining:
+            socks = {'listen': self.sock}
+            if self.side is not None:
+                socks['stats'] = self.side
+            log.info('reloading as pid %d', prefork.reload(socks).pid)
+            self.drain()
+        elif signum == signal.SIGINT and self.draining:
+            self.stop()
+        elif signum in (signal.SIGINT, signal.SIGTERM):
+            self.drain()
+
+    def drain(self):
+        """Stop accepting, close connections that are between
+        requests, and let the rest finish until the drain deadline.
+        Closing the listening sockets refuses new clients, unless a
+        reload has given a new process its own copies."""
+
+        if self.draining:
+            return
+        log.info('draining %d connections', len(self.clients))
+        self.draining = True
+        self.srv.close()
+        if self.side is not None:
+            self.loop.remove_reader(self.side.fileno())
+            self.side.close()
+        self.loop.call_later(self.drain_timeout, self.stop)
+        for proto in list(self.clients):
+            proto.update()
+        if not self.clients:
+            self.stop()
+
+    def stop(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def expire(self):
+        """Hang up on connections whose deadline has passed."""
+
+        now = self.loop.time()
+        for proto in list(self.clients):
+            proto.conn.progress(now)
+            if self.deadline(proto.conn) <= now:
+                self.metrics['timeouts_total'].inc()
+                proto.conn.abort()
+        self.sweep = self.loop.call_later(self.sweep_interval, self.expire)
+
+    def deadline(self, conn):
+        """The time by which the connection must have moved on, as
+        httpd-kqueue.py reckons it: output waiting on the client, a
+        request head that is taking too long to arrive however slowly
+        it trickles in, or an idle keep-alive connection."""
+
+        if conn.pending:
+            return conn.active + self.write_timeout
+        elif conn.started:
+            return conn.started + self.header_timeout
+        else:
+            return conn.active + self.idle
+
+    def collect(self):
+        for conn in self.offload.collect():
+            if conn is not None:
+                conn.proto.update()
+
+    def lag(self, due):
+        """The loop's iterations cannot be timed from outside, but a
+        busy loop runs this callback late."""
+
+        now = self.loop.time()
+        self.metrics['loop_lag_seconds'].observe(max(0, now - due))
+        self.loop.call_later(self.lag_interval, self.lag, now + self.lag_interval)
+
+class protocol(asyncio.BufferedProtocol):
+
+    def __init__(self, server):
+        self.server = server
+        self.handle = server.handle
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn = connection(self, transport)
+        self.conn.active = self.server.loop.time()
+        transport.set_write_buffer_limits(self.conn.high_water, self.conn.low_water)
+        self.server.clients.add(self)
+        metrics = self.server.metrics
+        metrics['connections_accepted_total'].inc()
+        waiting = acceptor.depth(self.server.sock)
+        if waiting is not None:
+            metrics['accept_queue_depth'].observe(waiting)
+
+    def connection_lost(self, exc):
+        self.server.clients.discard(self)
+        self.conn.close()
+        stats.closed(self.server.metrics, self.conn)
+        if self.server.draining and not self.server.clients:
+            self.server.stop()
+
+    def get_buffer(self, sizehint):
+        return self.conn._rview
+
+    def buffer_updated(self, nbytes):
+        conn = self.conn
+        conn._rpos = 0; conn._rlen = nbytes
+        conn.received += nbytes
+        conn.active = self.server.loop.time()
+        self.handle(conn)
+        self.update()
+
+    def eof_received(self):
+        ## Keep the transport open to finish sending any replies.
+        self.conn.close_when_done()
+        self.update()
+        return True
+
+    def pause_writing(self):
+        conn = self.conn
+        conn.paused = True
+        conn._drain = self.server.loop.create_future()
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.conn.active = self.server.loop.time()
+        (drain, self.conn._drain) = (self.conn._drain, None)
+        if drain is not None:
+            drain.set_result(None)
+        self.resume()
+
+    def resume(self):
+        conn = self.conn
+        if conn._sending is not None or conn._drain is not None:
+            return
+        conn.paused = False
+        if not self.transport.is_closing():
+            ## Answer requests that were held back while the client
+            ## was not keeping up.
+            self.handle(conn)
+            self.update()
+
+    def update(self):
+        conn = self.conn
+        if self.server.draining and conn.idle and conn.received:
+            ## A client that has not sent anything yet is about to,
+            ## so it gets its answer before the connection closes.
+            conn.close_when_done()
+
+        if conn.closing:
+            if conn._sending is None:
+                ## Closing waits for the write buffer to be flushed.
+                self.transport.close()
+        elif conn.paused:
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
+
+class connection(io.RawIOBase):
+    """The asyncio counterpart of evio.connection.  Reads come from a
+    preallocated buffer that the transport fills; output goes to the
+    transport, except for file segments, which are sent with
+    loop.sendfile() while later output waits behind them."""
+
+    high_water = evio.connection.high_water
+    low_water = evio.connection.low_water
+
+    def __init__(self, proto, transport):
+        self.proto = proto
+        self.transport = transport
+
+        self._rpos = self._rlen = 0
+        self._rbuf = bytearray(io.DEFAULT_BUFFER_SIZE)
+        self._rview = memoryview(self._rbuf)
+
+        self._backlog = []
+        self._sending = None
+        self._drain = None
+        ## Bytes the transport had passed to the socket at the last
+        ## sweep; see progress().
+        self._flushed = 0
+        self.paused = False
+
+        self.data = None
+        self.active = 0
+        self.started = 0
+        self.closing = False
+        ## Bytes received, and bytes handed to the transport.
+        self.received = self.sent = 0
+
+    readinto = evio.connection.readinto
+    consume = evio.connection.consume
+    close_when_done = evio.connection.close_when_done
+    _readinto_from_buffer = evio.connection._readinto_from_buffer
+
+    @property
+    def idle(self):
+        return self._sending is None and not self._backlog and getattr(self.data, 'idle', True)
+
+    @property
+    def pending(self):
+        """True while output is waiting on the client."""
+        return self._sending is not None or bool(self._backlog) or self.transport.get_write_buffer_size() > 0
+
+    def progress(self, now):
+        """Count output that has left the transport's buffer since the
+        last call as activity.  The transport does not report it as it
+        happens, so the server's sweep asks."""
+
+        flushed = self.sent - self.transport.get_write_buffer_size()
+        if flushed > self._flushed:
+            self._flushed = flushed
+            self.active = now
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.push(b)
+        return len(b)
+
+    def push(self, *buffers):
+        if self._sending is not None:
+            self._backlog.extend(buffers)
+            return
+
+        out = []
+        for (i, b) in enumerate(buffers):
+            if type(b) is evio.segment:
+                if out:
+                    self.transport.writelines(out)
+                    self.sent += sum(map(len, out))
+                self._sending = asyncio.ensure_future(self._sendfile(b))
+                self._backlog.extend(buffers[i + 1:])
+                ## Hold back further requests until the file is sent.
+                self.paused = True
+                self.transport.pause_reading()
+                return
+            out.append(b)
+
+        if out:
+            self.transport.writelines(out)
+            self.sent += sum(map(len, out))
+
+    async def _sendfile(self, seg):
+        loop = asyncio.get_running_loop()
+        try:
+            with open(seg.file.fileno(), 'rb', closefd=False) as file:
+                try:
+                    while seg.count:
+                        count = await loop.sendfile(self.transport, file, seg.offset, min(seg.count, SENDFILE_CHUNK), fallback=False)
+                        if not count:
+                            raise OSError('File ended before the segment was sent.')
+                        self.sent += count; self.active = loop.time()
+                        seg.offset += count; seg.count -= count
+                except (asyncio.SendfileNotAvailableError, NotImplementedError):
+                    await self._pread(seg)
+        except (OSError, RuntimeError):
+            self.transport.abort()
+        finally:
+            seg.close()
+
+        self._sending = None
+        if not self.transport.is_closing():
+            (backlog, self._backlog) = (self._backlog, [])
+            self.push(*backlog)
+            if self._sending is None:
+                self.proto.update()
+                self.proto.resume()
+
+    async def _pread(self, seg):
+        """Send a segment through the transport when the loop cannot
+        use os.sendfile().  The descriptor may be shared, so read at
+        explicit offsets rather than seeking."""
+
+        fd = seg.file.fileno()
+        while seg.count:
+            data = os.pread(fd, min(seg.count, 256 * 1024), seg.offset)
+            if not data:
+                raise OSError('File ended before the segment was sent.')
+            self.transport.write(data)
+            self.sent += len(data)
+            seg.offset += len(data); seg.count -= len(data)
+            if self._drain is not None:
+                await self._drain
+                self.active = asyncio.get_running_loop().time()
+
+    def abort(self):
+        """Hang up without sending the rest of the output.  A file
+        being sent is cancelled first: the loop's sendfile puts the
+        transport back in its tables when it finishes, which must not
+        happen after the transport is gone."""
+
+        if self._sending is not None and not self._sending.done():
+            self._sending.add_done_callback(lambda task: self.transport.abort())
+            self._sending.cancel()
+        else:
+            self.transport.abort()
+
+    def close(self):
+        self.data = None
+        for b in self._backlog:
+            if type(b) is evio.segment:
+                b.close()
+        self._backlog = []
+        if self._sending is not None:
+            self._sending.cancel()
+
+## Bytes per loop.sendfile() call.  Each piece sent counts as
+## progress for the write timeout.
+SENDFILE_CHUNK = 256 * 1024
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='A "hello world" web server.')
+    parser.add_argument('--addr', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--idle', type=float, default=30.0, help='idle keep-alive timeout in seconds')
+    parser.add_argument('--header-timeout', type=float, default=10.0, help='seconds allowed to send a request head')
+    parser.add_argument('--write-timeout', type=float, default=30.0, help='seconds allowed for a client to accept output')
+    parser.add_argument('--uvloop', action='store_true', help='run on uvloop')
+    parser.add_argument('--drain', type=float, default=10.0, help='seconds to let connections finish when stopping')
+    parser.add_argument('--root', help='serve the files under this directory')
+    parser.add_argument('--workers', type=int, help='prefork this many SO_REUSEPORT workers')
+    parser.add_argument('--stats', type=int, metavar='PORT', help='serve metrics on this port')
+    parser.add_argument('--threads', type=int, help='run the application on a pool of this many threads')
+    parser.add_argument('--queue-depth', type=int, help='answer 503 beyond this many requests waiting on the threads')
+    opts = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(message)s')
+    metrics = stats.server()
+    work = offload.pool(opts.threads, opts.queue_depth) if opts.threads else None
+    app = http11.handler(http11.static(opts.root) if opts.root else hello, metrics, work)
+
+    server(app, opts.idle, opts.uvloop, metrics, opts.drain, work, opts.header_timeout, opts.write_timeout)(opts.addr, opts.port, workers=opts.workers, stats_port=opts.stats)
+
+if __name__ == '__main__':
+    main()
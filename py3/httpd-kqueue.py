@@ -4,31 +4,87 @@ Copyright (c) 2009, Ben Weaver.  All rights reserved.
 This software is issued "as is" under a BSD license
 <http://orangesoda.net/license.html>.  All warranties disclaimed.
 
+The server loop is written against a small readiness backend
+interface.  On BSD and OS X it uses kqueue; on Linux it uses an
+edge-triggered epoll; anything else falls back to poll.  Pick one
+explicitly with --backend; see httpbench.py to compare them.  With
+--stats, connection, byte, loop and request metrics (see stats.py) are
+served on a second port.
+
+SIGINT or SIGTERM drains the server: it stops accepting and exits once
+its clients are done or --drain seconds have passed.  SIGHUP starts a
+new copy of the server on the same listening socket and drains this
+one (see prefork.py).
+
+With --threads, the application runs on a thread pool (see offload.py)
+so that a handler that blocks does not hold up the loop.
+
+Connections are accepted in batches of up to --accept-batch per wakeup
+(see acceptor.py), and an edge-triggered backend reads at most
+--read-batch buffers from a connection before moving on to the next.
+
 http://scotdoyle.com/python-epoll-howto.html
 http://wiki.netbsd.se/kqueue_tutorial
 """
-import sys, io, socket, select, errno
+import sys, abc, time, socket, select, signal, errno, logging, argparse
+import prefork, evio, http11, stats, timerwheel, offload, acceptor
+
+log = logging.getLogger('httpd')
+sample = stats.sampler(log, 1000)
 
-def handle(conn, hint):
-    print('%d bytes:' % hint, conn.read(hint))
-    conn.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\nContent-Length:13\r\n\r\nHello, world!')
+def hello(request):
+    sample('%s %s', request.method, request.target)
+    return http11.response(200, [('Content-Type', 'text/plain')], b'Hello, world!')
+
+handle = http11.handler(hello)
 
 class server(object):
 
-    def __init__(self, handle):
+    def __init__(self, handle, backend=None, idle=30.0, metrics=None, header_timeout=10.0, write_timeout=30.0, drain=10.0, offload=None, accept_batch=64, read_batch=2):
         self.handle = handle
-
-    def __call__(self, addr='127.0.0.1', port=8080, backlog=None, nevents=None):
-        sock = self.listen(addr, port, backlog)
+        self.offload = offload
+        self.accept_batch = accept_batch
+        self.read_batch = read_batch
+        self.backend = best() if backend is None else backend
+        self.idle = idle
+        self.header_timeout = header_timeout
+        self.write_timeout = write_timeout
+        self.drain_timeout = drain
+        self.metrics = stats.server() if metrics is None else metrics
+        self.metrics.connections = lambda: self.mgr
+
+    def __call__(self, addr='127.0.0.1', port=8080, backlog=None, nevents=None, workers=None, stats_port=None):
+        if workers:
+            ## Each worker binds its own socket and the kernel
+            ## balances new connections between them.  The stats
+            ## port is shared the same way, so each scrape reports
+            ## on one worker.
+            prefork.supervisor(self.run, workers, grace=self.drain_timeout + 1)(
+                addr, port, backlog, nevents, stats_port, reuseport=True
+            )
+        else:
+            self.run(addr, port, backlog, nevents, stats_port)
+
+    def run(self, addr, port, backlog=None, nevents=None, stats_port=None, reuseport=False):
+        ## After a reload, carry on with the previous process's
+        ## sockets.
+        sock = prefork.inherited('listen') or self.listen(addr, port, backlog, reuseport)
+        side = prefork.inherited('stats')
+        if side is None and stats_port:
+            side = stats.listen(addr, stats_port, reuseport)
         try:
-            self.serve(sock, nevents)
+            self.serve(sock, nevents, side)
         finally:
             sock.close()
+            if side is not None:
+                side.close()
 
-    def listen(self, addr, port, backlog=None):
+    def listen(self, addr, port, backlog=None, reuseport=False):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind((addr, port))
         sock.listen(socket.SOMAXCONN if backlog is None else backlog)
         sock.setblocking(0)
@@ -36,60 +92,316 @@ class server(object):
 
         return sock
 
-    def serve(self, sock, nevents=None):
-        mgr = manager()
+    def serve(self, sock, nevents=None, side=None):
+        self.mgr = mgr = manager()
         nevents = socket.SOMAXCONN if nevents is None else nevents
 
-        with kqueue() as kq:
-
-            sockno = mgr.add(kq.event(sock), sock).fileno()
+        metrics = self.metrics
+        accepted = metrics['connections_accepted_total']
+        iteration = metrics['loop_iteration_seconds']
+        batch = metrics['loop_events']
+
+        self.sock = sock; self.side = side
+        self.draining = None
+        ## Edge-triggered connections whose read stopped at the
+        ## batch limit rather than at EAGAIN.  The kernel will not
+        ## report them again, so the loop reads them next time round.
+        self.ready = ready = {}
+
+        accept = self.accept = acceptor.acceptor(sock, metrics, self.accept_batch)
+        with self.backend() as poll, wakeup(SIGNALS) as signals:
+            self.poll = poll
+
+            ## The listening socket is always level-triggered so that
+            ## connections left over from a bounded batch of accepts
+            ## wake the loop again.
+            sockno = sock.fileno()
+            poll.register(sockno, poll.READ, level=True)
+            sideno = None
+            if side is not None:
+                sideno = side.fileno()
+                poll.register(sideno, poll.READ, level=True)
+            signo = signals.fileno()
+            poll.register(signo, poll.READ, level=True)
+            workno = None
+            if self.offload is not None:
+                ## Readable when requests handed to the thread pool
+                ## have been answered.
+                workno = self.offload.fileno()
+                poll.register(workno, poll.READ, level=True)
+
+            now = self.now = time.monotonic()
+            self.wheel = wheel = timerwheel.wheel(now)
             while True:
 
-                events = kq(nevents)
-                if not events:
-                    raise RuntimeError('serve: kqueue returned an empty list of events.')
-
-                for event in events:
-                    if event.flags & kq.ERROR:
-                        self.error(mgr.get(event), kq.error(event))
-                    elif event.ident == sockno:
-                        conn = self.start(sock)
-                        mgr.add(kq.event(conn), conn)
+                timeout = wheel.timeout(now)
+                if accept.resume is not None and self.draining is None:
+                    if now >= accept.resume:
+                        accept.resume = None
+                        poll.modify(sockno, poll.READ, level=True)
                     else:
-                        if event.flags & kq.READ and event.data > 0:
-                            self.handle(mgr.get(event), event.data)
-                        if event.flags & kq.EOF:
-                            self.finish(mgr.pop(event))
-
-    def error(self, conn, message):
-        print('ERROR', conn and conn.getsockname(), message)
-
-    def start(self, sock):
-        conn, addr = sock.accept()
-        conn.setblocking(0)
-        return conn
+                        left = accept.resume - now
+                        timeout = left if timeout is None else min(timeout, left)
+                if self.draining is not None:
+                    if not mgr or now >= self.draining:
+                        break
+                    left = self.draining - now
+                    timeout = left if timeout is None else min(timeout, left)
+                if ready:
+                    timeout = 0
+
+                events = poll(nevents, timeout)
+                now = self.now = time.monotonic()
+
+                for (fd, flags, data) in events:
+                    if fd == signo:
+                        self.signalled(signals.read())
+                    elif fd == workno:
+                        for conn in self.offload.collect():
+                            if conn is not None:
+                                self.update(conn)
+                    elif flags & poll.ERROR:
+                        conn = mgr.get(fd)
+                        self.error(conn, data)
+                        if conn is not None:
+                            self.drop(conn)
+                    elif fd == sockno:
+                        if self.draining is not None:
+                            continue
+                        for client in accept(now):
+                            conn = mgr.add(client)
+                            conn.active = now
+                            conn.events = poll.READ
+                            poll.register(conn.fileno(), poll.READ)
+                            self.deadline(conn)
+                            accepted.inc()
+                        if accept.resume is not None:
+                            ## Out of descriptors; leave the listener
+                            ## alone until some are freed.
+                            poll.modify(sockno, 0, level=True)
+                    elif fd == sideno:
+                        stats.serve(side, metrics)
+                    else:
+                        conn = mgr.get(fd)
+                        if conn is None:
+                            continue
+                        if flags & poll.WRITE:
+                            conn.active = now
+                            self.write(conn)
+                        if flags & poll.READ and not conn.paused:
+                            conn.active = now
+                            if not self.read(conn, poll.edge):
+                                flags |= poll.EOF
+                        if flags & poll.EOF:
+                            ## The peer may only have shut down its side;
+                            ## finish sending before hanging up.
+                            conn.close_when_done()
+                        self.update(conn)
+
+                if ready:
+                    pending = list(ready.values())
+                    ready.clear()
+                    for conn in pending:
+                        if conn.closing or conn.paused:
+                            ## A paused connection is registered for
+                            ## reading again once it catches up, and
+                            ## the kernel reports what is waiting.
+                            continue
+                        conn.active = now
+                        if not self.read(conn, poll.edge):
+                            conn.close_when_done()
+                        self.update(conn)
+
+                for timer in wheel.advance(now):
+                    self.expire(timer.data)
+
+                batch.observe(len(events))
+                iteration.observe(time.monotonic() - now)
+
+            for conn in list(mgr):
+                self.drop(conn)
+            accept.close()
+
+    def signalled(self, signums):
+        """SIGINT and SIGTERM start draining, and a second SIGINT stops
+        at once.  SIGHUP starts a new process with the same sockets and
+        drains this one."""
+
+        for signum in signums:
+            if signum == signal.SIGHUP and self.draining is None:
+                socks = {'listen': self.sock}
+                if self.side is not None:
+                    socks['stats'] = self.side
+                log.info('reloading as pid %d', prefork.reload(socks).pid)
+                self.drain()
+            elif signum == signal.SIGINT and self.draining is not None:
+                self.draining = self.now
+            elif signum in (signal.SIGINT, signal.SIGTERM):
+                self.drain()
+
+    def drain(self):
+        """Stop accepting, close connections that are between
+        requests, and let the rest finish until the drain deadline.
+        Closing the listening sockets refuses new clients, unless a
+        reload has given a new process its own copies."""
+
+        if self.draining is not None:
+            return
+        log.info('draining %d connections', len(self.mgr))
+        self.draining = self.now + self.drain_timeout
+        for sock in (self.sock, self.side):
+            if sock is not None:
+                self.poll.discard(sock.fileno())
+                sock.close()
+        for conn in list(self.mgr):
+            self.update(conn)
+
+    def read(self, conn, edge=False):
+        """Fill the connection's buffer and hand it to the handler.
+        An edge-triggered backend will not report this connection
+        again until new data arrives, so keep reading until the
+        socket would block -- or, so that one busy client cannot
+        starve the rest, until read_batch buffers have been handled,
+        leaving the connection on the ready list.  Return False when
+        the peer has closed the connection."""
+
+        for _ in range(self.read_batch if edge else 1):
+            size = conn._fill_buffer()
+            if size is None:
+                return True
+            elif not size:
+                return False
+            self.handle(conn)
+            if conn.closing or conn.paused:
+                return True
+        if edge:
+            self.ready[conn.fileno()] = conn
+        return True
+
+    def write(self, conn):
+        paused = conn.paused
+        conn._flush_output()
+        if paused and not conn.paused:
+            ## Answer requests that were held back while the client
+            ## was not keeping up.
+            self.handle(conn)
+
+    def update(self, conn):
+        """Register the readiness the connection is interested in now
+        that its output queue has changed.  Hang up on connections
+        that are closing and have nothing left to send."""
+
+        if self.draining is not None and conn.idle and conn.received:
+            ## A client that has not sent anything yet is about to,
+            ## so it gets its answer before the connection closes.
+            conn.close_when_done()
+
+        (read, write) = conn.interest()
+        if conn.closing and not write:
+            return self.drop(conn)
+
+        events = (self.poll.READ if read else 0) | (self.poll.WRITE if write else 0)
+        if events != conn.events:
+            conn.events = events
+            self.poll.modify(conn.fileno(), events)
+        self.deadline(conn)
+
+    def deadline(self, conn):
+        """Arm the connection's timer for the timeout that applies to
+        it now: output waiting on the client, a request head that is
+        taking too long to arrive however slowly it trickles in, or
+        an idle keep-alive connection."""
+
+        if conn.timer is None:
+            conn.timer = timerwheel.timer(conn)
+        if conn.pending:
+            when = conn.active + self.write_timeout
+        elif conn.started:
+            when = conn.started + self.header_timeout
+        else:
+            when = conn.active + self.idle
+        self.wheel.arm(conn.timer, when)
+
+    def expire(self, conn):
+        """The timer has come up; the deadline may have moved since
+        it was armed."""
+
+        self.deadline(conn)
+        if conn.timer.deadline <= self.now:
+            self.metrics['timeouts_total'].inc()
+            self.drop(conn)
+
+    def drop(self, conn):
+        fd = conn.fileno()
+        self.poll.discard(fd)
+        self.ready.pop(fd, None)
+        self.wheel.cancel(conn.timer)
+        self.finish(self.mgr.pop(fd))
+        stats.closed(self.metrics, conn)
+
+    def error(self, conn, code):
+        if not code and conn is not None:
+            code = conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        log.warning('error on %s: %s', conn and conn.fileno(), errno.errorcode.get(code, code))
 
     def finish(self, conn):
-        ## Closing the socket deletes any associated events.
         conn.close()
 
-class kqueue(object):
-    ADD = select.KQ_EV_ADD
-    ENABLE = select.KQ_EV_ENABLE
-    ERROR = select.KQ_EV_ERROR
-    EOF = select.KQ_EV_EOF
+SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)
 
-    READ = select.KQ_FILTER_READ
-    WRITE = select.KQ_FILTER_WRITE
+class wakeup(object):
+    """Deliver signals to the event loop as readiness.  The handlers
+    do nothing; signal.set_wakeup_fd() writes each signal's number to
+    a socket that the loop polls, so a signal interrupts the wait
+    instead of being noticed at the next event."""
 
-    def __init__(self):
-        self._kq = select.kqueue()
-        self._changes = []
+    def __init__(self, signums):
+        self.signums = signums
 
-    def __call__(self, nevents):
-        events = self._kq.control(self._changes, nevents)
-        del self._changes[:]
-        return events
+    def __enter__(self):
+        (self._r, self._w) = socket.socketpair()
+        self._r.setblocking(0); self._w.setblocking(0)
+        self._previous = dict((n, signal.signal(n, self.ignore)) for n in self.signums)
+        self._fd = signal.set_wakeup_fd(self._w.fileno())
+        return self
+
+    def __exit__(self, *exc):
+        signal.set_wakeup_fd(self._fd)
+        for (signum, handler) in self._previous.items():
+            signal.signal(signum, handler)
+        self._r.close(); self._w.close()
+
+    def fileno(self):
+        return self._r.fileno()
+
+    def read(self):
+        try:
+            return list(self._r.recv(256))
+        except BlockingIOError:
+            return []
+
+    @staticmethod
+    def ignore(signum, frame):
+        pass
+
+
+### Backends
+
+class backend(abc.ABC):
+    """A readiness backend wraps a kernel event queue.  Calling it
+    waits for up to nevents events and returns a list of (fd, flags,
+    data) items.  The flags are a combination of READ, WRITE, EOF,
+    and ERROR; data is a backend-specific hint (an errno for kqueue
+    errors) or 0."""
+
+    READ = 0x01
+    WRITE = 0x02
+    EOF = 0x04
+    ERROR = 0x08
+
+    ## True when connections are registered edge-triggered; a reader
+    ## must then drain a socket until it would block.
+    edge = False
 
     def __enter__(self):
         return self
@@ -97,36 +409,246 @@ class kqueue(object):
     def __exit__(self, *exc):
         self.close()
 
-    def event(self, sock, filters=READ, flags=(ADD | ENABLE)):
-        event = select.kevent(sock.fileno(), filters, flags)
-        self._changes.append(event)
-        return event
+    @abc.abstractmethod
+    def __call__(self, nevents, timeout=None):
+        pass
 
-    def close(self):
-        return self._kq.close()
+    @abc.abstractmethod
+    def register(self, fd, events=READ, level=False):
+        pass
+
+    @abc.abstractmethod
+    def modify(self, fd, events, level=False):
+        pass
 
-    def error(self, event):
-        return errno.errorcode[event.data]
+    @abc.abstractmethod
+    def discard(self, fd):
+        """Forget about fd; it is about to be closed."""
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+BACKENDS = {}
+
+def best():
+    for name in ('kqueue', 'epoll', 'poll'):
+        if name in BACKENDS:
+            return BACKENDS[name]
+    raise RuntimeError('No readiness backend is available.')
+
+if hasattr(select, 'kqueue'):
+
+    class kqueue(backend):
+        name = 'kqueue'
+
+        ADD = select.KQ_EV_ADD
+        ENABLE = select.KQ_EV_ENABLE
+        DELETE = select.KQ_EV_DELETE
+
+        FILTERS = (
+            (backend.READ, select.KQ_FILTER_READ),
+            (backend.WRITE, select.KQ_FILTER_WRITE)
+        )
+
+        def __init__(self):
+            self._kq = select.kqueue()
+            self._changes = []
+            self._events = {}
+
+        def __call__(self, nevents, timeout=None):
+            events = self._kq.control(self._changes, nevents, timeout)
+            del self._changes[:]
+            return [(e.ident, self.flags(e), e.data) for e in events]
+
+        def flags(self, event):
+            if event.flags & select.KQ_EV_ERROR:
+                return self.ERROR
+            flags = self.READ if event.filter == select.KQ_FILTER_READ else self.WRITE
+            if event.flags & select.KQ_EV_EOF:
+                flags |= self.EOF
+            return flags
+
+        def register(self, fd, events=backend.READ, level=False):
+            self._events[fd] = 0
+            self.modify(fd, events)
+
+        def modify(self, fd, events, level=False):
+            old = self._events[fd]; self._events[fd] = events
+            for (bit, filter) in self.FILTERS:
+                if (old ^ events) & bit:
+                    self.event(fd, filter, (self.ADD | self.ENABLE) if events & bit else self.DELETE)
+
+        def discard(self, fd):
+            ## Closing the socket deletes any associated events, but
+            ## changes that have not been submitted yet would fail.
+            del self._events[fd]
+            if self._changes:
+                self._changes[:] = [c for c in self._changes if c.ident != fd]
+
+        def event(self, fd, filter, flags):
+            event = select.kevent(fd, filter, flags)
+            self._changes.append(event)
+            return event
+
+        def close(self):
+            return self._kq.close()
+
+    BACKENDS['kqueue'] = kqueue
+
+if hasattr(select, 'epoll'):
+
+    class epoll(backend):
+        name = 'epoll'
+        edge = True
+
+        def __init__(self):
+            self._ep = select.epoll()
+
+        def __call__(self, nevents, timeout=None):
+            return [
+                (fd, self.flags(mask), 0)
+                for (fd, mask) in self._ep.poll(-1 if timeout is None else timeout, nevents)
+            ]
+
+        def flags(self, mask):
+            flags = 0
+            if mask & select.EPOLLIN:
+                flags |= self.READ
+            if mask & select.EPOLLOUT:
+                flags |= self.WRITE
+            if mask & (select.EPOLLHUP | select.EPOLLRDHUP):
+                flags |= self.EOF
+            if mask & select.EPOLLERR:
+                flags |= self.ERROR
+            return flags
+
+        def mask(self, events, level=False):
+            mask = 0 if level else select.EPOLLET
+            if events & self.READ:
+                mask |= select.EPOLLIN | select.EPOLLRDHUP
+            if events & self.WRITE:
+                mask |= select.EPOLLOUT
+            return mask
+
+        def register(self, fd, events=backend.READ, level=False):
+            self._ep.register(fd, self.mask(events, level))
+
+        def modify(self, fd, events, level=False):
+            self._ep.modify(fd, self.mask(events, level))
+
+        def discard(self, fd):
+            ## A registration belongs to the open file, not the
+            ## descriptor: it outlives close() while a copy of the
+            ## descriptor is open elsewhere, as the listener is in a
+            ## reloaded process.
+            try:
+                self._ep.unregister(fd)
+            except OSError:
+                pass
+
+        def close(self):
+            return self._ep.close()
+
+    BACKENDS['epoll'] = epoll
+
+if hasattr(select, 'poll'):
+
+    class poll(backend):
+        name = 'poll'
+
+        def __init__(self):
+            self._poll = select.poll()
+
+        def __call__(self, nevents, timeout=None):
+            events = self._poll.poll(None if timeout is None else timeout * 1000)
+            return [(fd, self.flags(mask), 0) for (fd, mask) in events[:nevents]]
+
+        def flags(self, mask):
+            flags = 0
+            if mask & (select.POLLIN | select.POLLPRI):
+                flags |= self.READ
+            if mask & select.POLLOUT:
+                flags |= self.WRITE
+            if mask & select.POLLHUP:
+                flags |= self.EOF
+            if mask & (select.POLLERR | select.POLLNVAL):
+                flags |= self.ERROR
+            return flags
+
+        def mask(self, events):
+            mask = 0
+            if events & self.READ:
+                mask |= select.POLLIN | select.POLLPRI
+            if events & self.WRITE:
+                mask |= select.POLLOUT
+            return mask
+
+        def register(self, fd, events=backend.READ, level=False):
+            self._poll.register(fd, self.mask(events))
+
+        def modify(self, fd, events, level=False):
+            self._poll.modify(fd, self.mask(events))
+
+        def discard(self, fd):
+            self._poll.unregister(fd)
+
+        def close(self):
+            pass
+
+    BACKENDS['poll'] = poll
+
+
+### Connections
 
 class manager(object):
 
     def __init__(self):
         self._conn = {}
 
-    def add(self, event, sock):
-        self._conn[event.ident] = conn = connection(sock, 'rwb')
-        return conn
-
-    def get(self, event):
-        return self._conn.get(event.ident)
+    def __iter__(self):
+        return iter(self._conn.values())
 
-    def pop(self, event):
-        return self._conn.pop(event.ident)
+    def __len__(self):
+        return len(self._conn)
 
-class connection(socket.SocketIO):
+    def add(self, sock):
+        self._conn[sock.fileno()] = conn = evio.connection(sock)
+        return conn
 
-    def close(self):
-        return self._sock.close()
+    def get(self, fd):
+        return self._conn.get(fd)
+
+    def pop(self, fd):
+        return self._conn.pop(fd)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='A "hello world" web server.')
+    parser.add_argument('--addr', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default=best().name)
+    parser.add_argument('--nevents', type=int)
+    parser.add_argument('--accept-batch', type=int, default=64, help='accept up to this many connections per wakeup')
+    parser.add_argument('--read-batch', type=int, default=2, help='read up to this many buffers from a connection per wakeup')
+    parser.add_argument('--idle', type=float, default=30.0, help='idle keep-alive timeout in seconds')
+    parser.add_argument('--header-timeout', type=float, default=10.0, help='seconds allowed to send a request head')
+    parser.add_argument('--write-timeout', type=float, default=30.0, help='seconds allowed for a client to accept output')
+    parser.add_argument('--drain', type=float, default=10.0, help='seconds to let connections finish when stopping')
+    parser.add_argument('--root', help='serve the files under this directory')
+    parser.add_argument('--workers', type=int, help='prefork this many SO_REUSEPORT workers')
+    parser.add_argument('--stats', type=int, metavar='PORT', help='serve metrics on this port')
+    parser.add_argument('--threads', type=int, help='run the application on a pool of this many threads')
+    parser.add_argument('--queue-depth', type=int, help='answer 503 beyond this many requests waiting on the threads')
+    opts = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(message)s')
+    metrics = stats.server()
+    work = offload.pool(opts.threads, opts.queue_depth) if opts.threads else None
+    app = http11.handler(http11.static(opts.root) if opts.root else hello, metrics, work)
+
+    server(app, BACKENDS[opts.backend], opts.idle, metrics, opts.header_timeout, opts.write_timeout, opts.drain, work, opts.accept_batch, opts.read_batch)(
+        opts.addr, opts.port, nevents=opts.nevents, workers=opts.workers, stats_port=opts.stats
+    )
 
 if __name__ == '__main__':
-    server(handle)()
+    main()
@@ -4,31 +4,71 @@ Copyright (c) 2009, Ben Weaver.  All rights reserved.
 This software is issued "as is" under a BSD license
 <http://orangesoda.net/license.html>.  All warranties disclaimed.
 
+With --threads, the application runs on a thread pool (see offload.py);
+the pool wakes the loop through an Async watcher.  Connections are
+accepted in batches of up to --accept-batch (see acceptor.py).
 """
 
-import sys, io, socket, pyev, signal
+import sys, time, socket, pyev, signal, logging, argparse
+import prefork, evio, http11, stats, timerwheel, offload, acceptor
 
-def handle(conn):
-    data = conn.read(io.DEFAULT_BUFFER_SIZE)
-    print('%d bytes:' % len(data), data)
-    conn.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\nContent-Length:13\r\n\r\nHello, world!')
+log = logging.getLogger('httpd')
+sample = stats.sampler(log, 1000)
+
+def hello(request):
+    sample('%s %s', request.method, request.target)
+    return http11.response(200, [('Content-Type', 'text/plain')], b'Hello, world!')
+
+handle = http11.handler(hello)
 
 class server(object):
 
-    def __init__(self, handle):
+    def __init__(self, handle, idle=30.0, pool_size=1024, metrics=None, header_timeout=10.0, write_timeout=30.0, drain=10.0, offload=None, accept_batch=64):
         self.handle = handle
+        self.offload = offload
+        self.accept_batch = accept_batch
+        self.idle = idle
+        self.header_timeout = header_timeout
+        self.write_timeout = write_timeout
+        self.drain_timeout = drain
+        self.pool = pool(pool_size)
+        self.metrics = stats.server() if metrics is None else metrics
+        self.metrics.connections = lambda: self.clients.values()
+        self.metrics.gauge('pool_hits_total', 'Connections reused from the pool.', lambda: self.pool.hits, 'counter')
+        self.metrics.gauge('pool_misses_total', 'Connections allocated.', lambda: self.pool.misses, 'counter')
 
-    def __call__(self, addr='127.0.0.1', port=8080, backlog=None):
-        sock = self.listen(addr, port, backlog)
+    def __call__(self, addr='127.0.0.1', port=8080, backlog=None, workers=None, stats_port=None):
+        if workers:
+            ## Each worker binds its own socket and the kernel
+            ## balances new connections between them.  The stats
+            ## port is shared the same way, so each scrape reports
+            ## on one worker.
+            prefork.supervisor(self.run, workers, grace=self.drain_timeout + 1)(
+                addr, port, backlog, stats_port, reuseport=True
+            )
+        else:
+            self.run(addr, port, backlog, stats_port)
+
+    def run(self, addr, port, backlog=None, stats_port=None, reuseport=False):
+        ## After a reload, carry on with the previous process's
+        ## sockets.
+        sock = prefork.inherited('listen') or self.listen(addr, port, backlog, reuseport)
+        side = prefork.inherited('stats')
+        if side is None and stats_port:
+            side = stats.listen(addr, stats_port, reuseport)
         try:
-            self.serve(sock)
+            self.serve(sock, side)
         finally:
             sock.close()
+            if side is not None:
+                side.close()
 
-    def listen(self, addr, port, backlog=None):
+    def listen(self, addr, port, backlog=None, reuseport=False):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind((addr, port))
         sock.listen(socket.SOMAXCONN if backlog is None else backlog)
         sock.setblocking(0)
@@ -36,73 +76,299 @@ class server(object):
 
         return sock
 
-    def serve(self, sock, nevents=None):
+    def serve(self, sock, side=None):
         loop = pyev.default_loop()
 
         self.clients = {}
+        self.draining = False
+        self.acceptor = acceptor.acceptor(sock, self.metrics, self.accept_batch)
         main = pyev.Io(sock, pyev.EV_READ, loop, self.accept, data=sock)
         main.start()
+        self.listeners = [main]
+
+        if side is not None:
+            scrape = pyev.Io(side, pyev.EV_READ, loop, self.scrape, data=side)
+            scrape.start()
+            self.listeners.append(scrape)
+        watchers = self.watchers = list(self.listeners)
+
+        ## Every connection timeout lives in the wheel; one Timer is
+        ## set for the nearest of them before the loop blocks.
+        self.wheel = timerwheel.wheel(loop.now())
+        self.alarm = pyev.Timer(0.0, 0.0, loop, self.tick)
+        watchers.append(self.alarm)
+
+        ## Check watchers run as soon as the loop has collected a
+        ## batch of events; prepare watchers run before it blocks
+        ## again.  The time between them is one iteration.
+        self.batch = None; self.nevents = 0
+        check = pyev.Check(loop, self.check)
+        check.start()
+        prepare = pyev.Prepare(loop, self.prepare)
+        prepare.start()
+        watchers.extend((check, prepare))
+
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            sig = pyev.Signal(signum, loop, self.signalled, data=signum)
+            sig.start()
+            watchers.append(sig)
+
+        if self.offload is not None:
+            ## Worker threads may not touch the loop, except to send
+            ## this watcher.
+            wake = pyev.Async(loop, self.collect)
+            wake.start()
+            self.offload.wake = wake.send
+            watchers.append(wake)
+
+        ## Watches the listener again once descriptors have been
+        ## freed.
+        self.resume_timer = pyev.Timer(0.0, 0.0, loop, self.resume)
+        watchers.append(self.resume_timer)
 
-        sigint = pyev.Signal(signal.SIGINT, loop, self.sigint, data=[main])
-        sigint.start()
+        ## Fires when draining has gone on too long.
+        self.deadline_timer = pyev.Timer(self.drain_timeout, 0.0, loop, self.stop)
+        watchers.append(self.deadline_timer)
 
-        loop.loop()
+        try:
+            loop.loop()
+        finally:
+            self.acceptor.close()
+
+    def signalled(self, watcher, events):
+        """SIGINT and SIGTERM start draining, and a second SIGINT stops
+        at once.  SIGHUP starts a new process with the same sockets and
+        drains this one."""
+
+        signum = watcher.data
+        if signum == signal.SIGHUP and not self.draining:
+            socks = dict(zip(('listen', 'stats'), (w.data for w in self.listeners)))
+            log.info('reloading as pid %d', prefork.reload(socks).pid)
+            self.drain(watcher.loop)
+        elif signum == signal.SIGINT and self.draining:
+            self.stop(watcher, events)
+        elif signum in (signal.SIGINT, signal.SIGTERM):
+            self.drain(watcher.loop)
+
+    def drain(self, loop):
+        """Stop accepting, close connections that are between
+        requests, and let the rest finish until the drain deadline.
+        Closing the listening sockets refuses new clients, unless a
+        reload has given a new process its own copies."""
 
-    def sigint(self, watcher, events):
+        if self.draining:
+            return
+        log.info('draining %d connections', len(self.clients))
+        self.draining = True
+        for w in self.listeners:
+            w.stop()
+            w.data.close()
+        self.deadline_timer.start()
+        for (w, conn) in list(self.clients.items()):
+            self.update(w, conn)
+        if not self.clients:
+            self.stop(self.deadline_timer, 0)
+
+    def stop(self, watcher, events):
         try:
-            for w in self.clients.keys():
+            for w in list(self.clients):
                 self.finish(w)
-            for w in watcher.data:
+            for w in self.watchers:
                 w.stop()
         finally:
             watcher.loop.unloop()
 
+    def check(self, watcher, events):
+        self.batch = time.monotonic(); self.nevents = 0
+
+    def prepare(self, watcher, events):
+        if self.batch is not None:
+            self.metrics['loop_iteration_seconds'].observe(time.monotonic() - self.batch)
+            self.metrics['loop_events'].observe(self.nevents)
+            self.batch = None
+
+        timeout = self.wheel.timeout(watcher.loop.now())
+        self.alarm.stop()
+        if timeout is not None:
+            self.alarm.set(timeout, 0.0)
+            self.alarm.start()
+
+    def tick(self, watcher, events):
+        for timer in self.wheel.advance(watcher.loop.now()):
+            self.expire(timer.data)
+
+    def collect(self, watcher, events):
+        for conn in self.offload.collect():
+            if conn is not None:
+                self.update(conn.watcher, conn)
+
+    def scrape(self, watcher, events):
+        stats.serve(watcher.data, self.metrics)
+
     def accept(self, watcher, events):
-        sock, addr = watcher.data.accept()
-        sock.setblocking(0)
+        now = watcher.loop.now()
+        accepted = self.metrics['connections_accepted_total']
+        for sock in self.acceptor(now):
+            conn = self.pool.get(sock, watcher.loop, self.io)
+            conn.active = now
+            self.clients[conn.watcher] = conn
+            conn.watcher.start()
+            self.deadline(conn)
+            accepted.inc()
+        self.nevents += 1
+
+        if self.acceptor.resume is not None:
+            ## Out of descriptors; leave the listener alone until
+            ## some are freed.
+            watcher.stop()
+            self.resume_timer.set(self.acceptor.resume - now, 0.0)
+            self.resume_timer.start()
+
+    def resume(self, watcher, events):
+        self.acceptor.resume = None
+        if not self.draining:
+            self.listeners[0].start()
+
+    def io(self, watcher, events):
+        conn = watcher.data
+        self.nevents += 1
+
+        if events & pyev.EV_WRITE:
+            conn.active = watcher.loop.now()
+            paused = conn.paused
+            conn._flush_output()
+            if paused and not conn.paused:
+                ## Answer requests that were held back while the
+                ## client was not keeping up.
+                self.handle(conn)
+
+        if events & pyev.EV_READ:
+            size = conn._fill_buffer()
+            if size:
+                conn.active = watcher.loop.now()
+                self.handle(conn)
+            elif size is not None:
+                conn.close_when_done()
+
+        self.update(watcher, conn)
+
+    def update(self, watcher, conn):
+        """Watch for the readiness the connection is interested in now
+        that its output queue has changed.  Hang up on connections
+        that are closing and have nothing left to send."""
 
-        conn = connection(sock)
-        wc = pyev.Io(sock, pyev.EV_READ, watcher.loop, self.read)
-        self.clients[wc] = conn
-        wc.start()
+        if self.draining and conn.idle and conn.received:
+            ## A client that has not sent anything yet is about to,
+            ## so it gets its answer before the connection closes.
+            conn.close_when_done()
 
-    def read(self, watcher, events):
-        conn = self.clients[watcher]
-        if conn._fill_buffer():
-            self.handle(conn)
+        (read, write) = conn.interest()
+        if conn.closing and not write:
+            return self.finish(watcher)
+
+        events = (pyev.EV_READ if read else 0) | (pyev.EV_WRITE if write else 0)
+        if events != watcher.events:
+            watcher.stop()
+            watcher.set(conn.fileno(), events)
+            watcher.start()
+        self.deadline(conn)
+
+    def deadline(self, conn):
+        """Arm the connection's timer for the timeout that applies to
+        it now: output waiting on the client, a request head that is
+        taking too long to arrive however slowly it trickles in, or
+        an idle keep-alive connection."""
+
+        if conn.timer is None:
+            conn.timer = timerwheel.timer(conn)
+        if conn.pending:
+            when = conn.active + self.write_timeout
+        elif conn.started:
+            when = conn.started + self.header_timeout
         else:
-            self.finish(watcher)
+            when = conn.active + self.idle
+        self.wheel.arm(conn.timer, when)
+
+    def expire(self, conn):
+        """The timer has come up; the deadline may have moved since
+        it was armed."""
+
+        self.deadline(conn)
+        if conn.timer.deadline <= conn.watcher.loop.now():
+            self.metrics['timeouts_total'].inc()
+            self.finish(conn.watcher)
 
     def finish(self, watcher):
         watcher.stop()
-        self.clients.pop(watcher).close()
+        conn = self.clients.pop(watcher)
+        self.wheel.cancel(conn.timer)
+        conn.close()
+        stats.closed(self.metrics, conn)
+        self.pool.put(conn)
+        if self.draining and not self.clients:
+            watcher.loop.unloop()
+
+class pool(object):
+    """A bounded free-list of connections.  Each pooled connection
+    keeps its receive buffer, output deque, and Io watcher, so an
+    accept storm reuses them instead of allocating new ones."""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.hits = self.misses = 0
+        self._free = []
 
-class connection(socket.SocketIO):
+    def __repr__(self):
+        return '<%s free=%d hits=%d misses=%d>' % (
+            type(self).__name__, len(self._free), self.hits, self.misses
+        )
+
+    def get(self, sock, loop, callback):
+        if self._free:
+            self.hits += 1
+            conn = self._free.pop()
+            conn.reset(sock)
+            conn.watcher.set(sock, pyev.EV_READ)
+        else:
+            self.misses += 1
+            conn = connection(sock)
+            conn.watcher = pyev.Io(sock, pyev.EV_READ, loop, callback, data=conn)
+        return conn
 
-    def __init__(self, sock):
-        super(connection, self).__init__(sock, 'rwb')
+    def put(self, conn):
+        if len(self._free) < self.size:
+            self._free.append(conn)
 
-        self._rpos = self._rlen = 0
-        self._rbuf = bytearray(io.DEFAULT_BUFFER_SIZE)
+    def stats(self):
+        return dict(free=len(self._free), hits=self.hits, misses=self.misses)
 
-    def readinto(self, b):
-        self._checkClosed()
-        self._checkReadable()
-        return self._readinto_from_buffer(b)
+class connection(evio.connection):
+    ## The Io watcher that pool.get() made for the connection.
+    watcher = None
 
-    def _readinto_from_buffer(self, b):
-        size = min(self._rlen, len(b)); end = self._rpos + size
-        b[0:size] = self._rbuf[self._rpos:end]
-        self._rpos = end; self._rlen -= size
-        return size
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='A "hello world" web server.')
+    parser.add_argument('--addr', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--idle', type=float, default=30.0, help='idle keep-alive timeout in seconds')
+    parser.add_argument('--header-timeout', type=float, default=10.0, help='seconds allowed to send a request head')
+    parser.add_argument('--write-timeout', type=float, default=30.0, help='seconds allowed for a client to accept output')
+    parser.add_argument('--drain', type=float, default=10.0, help='seconds to let connections finish when stopping')
+    parser.add_argument('--accept-batch', type=int, default=64, help='accept up to this many connections per wakeup')
+    parser.add_argument('--pool', type=int, default=1024, help='keep up to this many closed connections for reuse')
+    parser.add_argument('--root', help='serve the files under this directory')
+    parser.add_argument('--workers', type=int, help='prefork this many SO_REUSEPORT workers')
+    parser.add_argument('--stats', type=int, metavar='PORT', help='serve metrics on this port')
+    parser.add_argument('--threads', type=int, help='run the application on a pool of this many threads')
+    parser.add_argument('--queue-depth', type=int, help='answer 503 beyond this many requests waiting on the threads')
+    opts = parser.parse_args(argv)
 
-    def _fill_buffer(self):
-        self._rpos = 0
-        self._rlen = self._sock.recv_into(self._rbuf)
-        return self._rlen
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(message)s')
+    metrics = stats.server()
+    work = offload.pool(opts.threads, opts.queue_depth) if opts.threads else None
+    app = http11.handler(http11.static(opts.root) if opts.root else hello, metrics, work)
 
-    def close(self):
-        return self._sock.close()
+    server(app, opts.idle, opts.pool, metrics, opts.header_timeout, opts.write_timeout, opts.drain, work, opts.accept_batch)(opts.addr, opts.port, workers=opts.workers, stats_port=opts.stats)
 
 if __name__ == '__main__':
-    server(handle)()
+    main()
@@ -0,0 +1,125 @@
+"""offload -- run blocking application code off the event loop.
+
+Copyright (c) 2009, Ben Weaver.  All rights reserved.
+This software is issued "as is" under a BSD license
+<http://orangesoda.net/license.html>.  All warranties disclaimed.
+
+A pool runs calls on a bounded concurrent.futures thread pool.  When a
+call finishes, its callback is queued for the loop thread and the loop
+is woken: through a socket pair that the loop polls, or through
+whatever wake function the server installs (a pyev Async watcher's
+send).  The loop then runs collect(), which calls the callbacks.
+Application code never touches a connection from a worker thread.
+
+No more than depth calls may be outstanding; submit() raises
+Overloaded beyond that, and http11.handler answers 503.
+
+    >>> p = pool(workers=2, depth=1)
+    >>> p.submit(sum, [1, 2], lambda f: f.result())
+    >>> p.submit(sum, [3, 4], lambda f: f.result())
+    Traceback (most recent call last):
+      ...
+    offload.Overloaded: 1 calls outstanding
+    >>> import select; r = select.select([p], [], [], 5)[0]
+    >>> p.collect(), len(p)
+    ([3], 0)
+    >>> p.close()
+"""
+
+import socket, threading, collections, concurrent.futures
+
+__all__ = ('Overloaded', 'pool')
+
+class Overloaded(Exception):
+    pass
+
+class pool(object):
+
+    def __init__(self, workers=8, depth=None):
+        self.workers = workers
+        self.depth = 8 * workers if depth is None else depth
+
+        ## Set by the server to wake its loop; the default writes to
+        ## a socket pair, created when the loop first asks for it.
+        self.wake = self._poke
+
+        self._executor = None
+        self._done = collections.deque()
+        self._outstanding = 0
+        self._lock = threading.Lock()
+        self._woken = False
+        self._r = self._w = None
+
+    def __len__(self):
+        return self._outstanding
+
+    def fileno(self):
+        """The descriptor the loop should poll for readability.  It
+        is created on first use, after any fork."""
+
+        if self._r is None:
+            (self._r, self._w) = socket.socketpair()
+            self._r.setblocking(0); self._w.setblocking(0)
+        return self._r.fileno()
+
+    def submit(self, fn, arg, callback):
+        """Call fn(arg) on a worker thread, then callback(future) on
+        the loop thread."""
+
+        if self._outstanding >= self.depth:
+            raise Overloaded('%d calls outstanding' % self._outstanding)
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, 'offload')
+            if self.wake == self._poke:
+                self.fileno()
+
+        self._outstanding += 1
+        future = self._executor.submit(fn, arg)
+        future.add_done_callback(lambda f: self._finished(f, callback))
+
+    def collect(self):
+        """Run the callbacks of finished calls, on the loop thread.
+        Return the list of their results."""
+
+        ## Empty the socket pair before clearing the flag: a call that
+        ## finishes in between then wakes the loop again rather than
+        ## leaving the flag set with nothing left to read.
+        if self._r is not None:
+            try:
+                while self._r.recv(4096):
+                    pass
+            except BlockingIOError:
+                pass
+        with self._lock:
+            self._woken = False
+
+        results = []
+        done = self._done
+        while done:
+            (future, callback) = done.popleft()
+            self._outstanding -= 1
+            results.append(callback(future))
+        return results
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        for sock in (self._r, self._w):
+            if sock is not None:
+                sock.close()
+
+    def _finished(self, future, callback):
+        ## Runs on the worker thread.  Wake the loop only once until it
+        ## collects, so the socket pair never fills up.
+        self._done.append((future, callback))
+        with self._lock:
+            if self._woken:
+                return
+            self._woken = True
+        self.wake()
+
+    def _poke(self):
+        try:
+            self._w.send(b'\0')
+        except BlockingIOError:
+            pass
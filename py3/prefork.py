@@ -0,0 +1,176 @@
+"""prefork -- run an event-loop server in several worker processes.
+
+Copyright (c) 2009, Ben Weaver.  All rights reserved.
+This software is issued "as is" under a BSD license
+<http://orangesoda.net/license.html>.  All warranties disclaimed.
+
+A supervisor forks N workers.  Each worker binds its own SO_REUSEPORT
+listening socket and runs its own event loop, so the kernel spreads
+new connections across all of them.  Workers that die are restarted.
+SIGINT or SIGTERM asks every worker to stop (with SIGINT, on which the
+servers stop accepting and drain their connections) and waits for
+them; workers still running after the grace period are killed.
+
+Linux balances connections between SO_REUSEPORT sockets; some BSDs
+hand them all to the most recently bound socket instead.
+
+SIGHUP reloads.  reload() starts a fresh copy of the program, which
+picks up new code; sockets handed to it are inherited by descriptor
+and found again with inherited().  A server reloads by passing on its
+listening socket and draining, so no connection is refused.  The
+supervisor passes nothing: the new generation of workers binds its
+own SO_REUSEPORT sockets, and the old one is drained once it has had
+time to start.
+"""
+
+import os, sys, time, signal, subprocess, traceback
+
+## Names and descriptors of inherited sockets: "listen=5,stats=6".
+FDS = 'HTTPD_FDS'
+
+class supervisor(object):
+
+    def __init__(self, worker, nworkers=None, grace=10.0, min_uptime=1.0):
+        self.worker = worker
+        self.nworkers = (os.cpu_count() or 1) if nworkers is None else nworkers
+        self.grace = grace
+        self.min_uptime = min_uptime
+        self.successor = None
+
+        self.children = {}
+        self.stopping = False
+
+    def __call__(self, *args, **kwargs):
+        previous = dict(
+            (signum, signal.signal(signum, self.stop))
+            for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGALRM)
+        )
+        previous[signal.SIGHUP] = signal.signal(signal.SIGHUP, self.reload)
+
+        try:
+            for slot in range(self.nworkers):
+                self.spawn(slot, args, kwargs)
+            self.supervise(args, kwargs)
+        finally:
+            signal.alarm(0)
+            for (signum, handler) in previous.items():
+                signal.signal(signum, handler)
+
+    def supervise(self, args, kwargs):
+        while self.children:
+            try:
+                (pid, status) = os.wait()
+            except ChildProcessError:
+                break
+
+            (slot, started) = self.children.pop(pid, (None, None))
+            if slot is None or self.stopping:
+                continue
+
+            self.died(pid, status)
+            if time.monotonic() - started < self.min_uptime:
+                ## Do not fork-bomb the machine when a worker cannot
+                ## even start (e.g. the port is taken).
+                time.sleep(self.min_uptime)
+            if not self.stopping:
+                self.spawn(slot, args, kwargs)
+
+    def spawn(self, slot, args, kwargs):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (slot, time.monotonic())
+            return pid
+
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            self.worker(*args, **kwargs)
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush(); sys.stderr.flush()
+            os._exit(status)
+
+    def stop(self, signum, frame):
+        if signum == signal.SIGALRM:
+            self.signal(signal.SIGKILL)
+        elif not self.stopping:
+            self.stopping = True
+            self.signal(signal.SIGINT)
+            signal.alarm(max(1, int(self.grace)))
+
+    def reload(self, signum, frame):
+        """Start the next generation and, once it is up, stop this
+        one.  If the new program fails to start, keep serving."""
+
+        if self.stopping or self.successor is not None:
+            return
+        self.successor = proc = reload()
+        time.sleep(self.min_uptime)
+        if proc.poll() is not None:
+            print('reload failed (%s); still serving' % describe_code(proc.returncode), file=sys.stderr)
+            self.successor = None
+            return
+        self.stop(signal.SIGINT, frame)
+
+    def signal(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def died(self, pid, status):
+        print('worker %d died (%s); restarting' % (pid, describe(status)), file=sys.stderr)
+
+def describe(status):
+    if os.WIFSIGNALED(status):
+        return 'signal %d' % os.WTERMSIG(status)
+    return 'status %d' % os.WEXITSTATUS(status)
+
+def describe_code(code):
+    return 'signal %d' % -code if code < 0 else 'status %d' % code
+
+
+### Reloading
+
+def reload(socks=None):
+    """Start a new copy of this program that inherits socks, a dict
+    of name to socket.  Return the subprocess.Popen."""
+
+    socks = socks or {}
+    env = dict(os.environ)
+    env.pop(FDS, None)
+    if socks:
+        env[FDS] = ','.join('%s=%d' % (name, sock.fileno()) for (name, sock) in socks.items())
+
+    return subprocess.Popen(
+        [sys.executable] + sys.argv, env=env,
+        pass_fds=[sock.fileno() for sock in socks.values()]
+    )
+
+def inherited(name):
+    """The socket named name that a reloading parent passed down, or
+    None.  Each one can be taken only once."""
+
+    import socket
+
+    fds = dict(item.split('=', 1) for item in os.environ.get(FDS, '').split(',') if item)
+    if name not in fds:
+        return None
+
+    fd = int(fds.pop(name))
+    if fds:
+        os.environ[FDS] = ','.join('%s=%s' % item for item in fds.items())
+    else:
+        del os.environ[FDS]
+
+    sock = socket.socket(fileno=fd)
+    sock.setblocking(0)
+    return sock
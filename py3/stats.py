@@ -0,0 +1,256 @@
+"""stats -- counters and histograms for the event-loop servers.
+
+Copyright (c) 2009, Ben Weaver.  All rights reserved.
+This software is issued "as is" under a BSD license
+<http://orangesoda.net/license.html>.  All warranties disclaimed.
+
+A registry holds named metrics and renders them in the Prometheus text
+format.  Counters only count up; a gauge calls a function when it is
+rendered, so values that can be read off the server's own state cost
+nothing until someone asks.  Histograms have power-of-two buckets, so
+an observation is a division and a bit_length().  A bucket counts the
+observations up to and including its bound.
+
+    >>> r = registry()
+    >>> c = r.counter('accepted_total', 'Connections accepted.')
+    >>> c.inc(); c.inc(2)
+    >>> h = r.histogram('batch_events', 'Events per batch.', base=1, buckets=4)
+    >>> for n in (0, 1, 2, 3, 100): h.observe(n)
+    >>> print(r.render(), end='')
+    # HELP accepted_total Connections accepted.
+    # TYPE accepted_total counter
+    accepted_total 3
+    # HELP batch_events Events per batch.
+    # TYPE batch_events histogram
+    batch_events_bucket{le="1"} 2
+    batch_events_bucket{le="2"} 3
+    batch_events_bucket{le="4"} 4
+    batch_events_bucket{le="+Inf"} 5
+    batch_events_sum 106
+    batch_events_count 5
+
+serve(listener, registry) answers each connection on a side listening
+socket with one HTTP/1.0 response holding the rendered metrics, so
+`curl localhost:9090` works.  sampler logs one in every n messages.
+"""
+
+import math, time, socket, logging
+
+__all__ = ('registry', 'counter', 'gauge', 'histogram', 'server', 'closed', 'listen', 'serve', 'sampler')
+
+class registry(object):
+
+    def __init__(self):
+        self._metrics = {}
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def __iter__(self):
+        return iter(self._metrics.values())
+
+    def add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError('Duplicate metric: %r.' % metric.name)
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help=''):
+        return self.add(counter(name, help))
+
+    def gauge(self, name, help, read, kind='gauge'):
+        return self.add(gauge(name, help, read, kind))
+
+    def histogram(self, name, help='', base=1e-6, buckets=28):
+        return self.add(histogram(name, help, base, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.lines())
+        lines.append('')
+        return '\n'.join(lines)
+
+class counter(object):
+    kind = 'counter'
+
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def lines(self):
+        return ['%s %s' % (self.name, number(self.value))]
+
+class gauge(object):
+    """A value computed by read() each time it is rendered.  A total
+    that only grows can be typed as a counter."""
+
+    def __init__(self, name, help, read, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.kind = kind
+
+    @property
+    def value(self):
+        return self.read()
+
+    def lines(self):
+        return ['%s %s' % (self.name, number(self.read()))]
+
+class histogram(object):
+    """Count observations in buckets whose upper bounds are base,
+    2 * base, 4 * base, ...; the last bucket is unbounded.  The
+    default base of a microsecond suits durations in seconds."""
+
+    kind = 'histogram'
+
+    __slots__ = ('name', 'help', 'base', 'counts', 'sum', 'count')
+
+    def __init__(self, name, help='', base=1e-6, buckets=28):
+        self.name = name
+        self.help = help
+        self.base = base
+        self.counts = [0] * buckets
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        ## A value equal to a bound belongs to that bound's bucket.
+        i = max(0, math.ceil(value / self.base) - 1).bit_length()
+        counts = self.counts
+        counts[i if i < len(counts) else -1] += 1
+        self.sum += value; self.count += 1
+
+    def quantile(self, q):
+        """The upper bound of the bucket holding the q-quantile.
+
+        >>> h = histogram('t', base=1, buckets=16)
+        >>> for n in range(100): h.observe(n)
+        >>> h.quantile(0.5), h.quantile(0.99)
+        (64, 128)
+        """
+
+        rank = q * self.count; seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.bound(i)
+        return None
+
+    def bound(self, i):
+        return self.base * 2 ** i if i < len(self.counts) - 1 else float('inf')
+
+    def lines(self):
+        lines = []; seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            le = self.bound(i)
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, '+Inf' if le == float('inf') else number(le), seen))
+        lines.append('%s_sum %s' % (self.name, number(self.sum)))
+        lines.append('%s_count %d' % (self.name, self.count))
+        return lines
+
+def number(value):
+    return '%d' % value if value == int(value) else '%.9g' % value
+
+
+### Servers
+
+def server():
+    """A registry with the metrics every server keeps.  The server
+    sets the registry's connections attribute to a function returning
+    its open connections; their byte totals are added to those of
+    closed connections when the metrics are rendered."""
+
+    r = registry()
+    r.connections = lambda: ()
+
+    accepted = r.counter('connections_accepted_total', 'Connections accepted.')
+    closed = r.counter('connections_closed_total', 'Connections closed.')
+    r.gauge('connections_open', 'Connections open now.', lambda: accepted.value - closed.value)
+    r.counter('timeouts_total', 'Connections closed by a timeout.')
+    r.histogram('accept_batch', 'Connections accepted per wakeup of the listener.', base=1, buckets=16)
+    r.histogram('accept_queue_depth', 'Connections waiting to be accepted at each wakeup.', base=1, buckets=16)
+    r.counter('accept_shed_total', 'Connections closed unanswered because descriptors ran out.')
+
+    received = r.counter('closed_bytes_received_total', 'Bytes received on closed connections.')
+    sent = r.counter('closed_bytes_sent_total', 'Bytes sent on closed connections.')
+    r.gauge('bytes_received_total', 'Bytes received.', lambda: received.value + sum(c.received for c in r.connections()), 'counter')
+    r.gauge('bytes_sent_total', 'Bytes sent.', lambda: sent.value + sum(c.sent for c in r.connections()), 'counter')
+
+    r.histogram('loop_iteration_seconds', 'Time spent handling one batch of events.')
+    r.histogram('loop_events', 'Events handled per batch.', base=1, buckets=16)
+    r.counter('requests_total', 'Requests answered.')
+    r.histogram('request_seconds', 'Time taken by the application per request.')
+    return r
+
+def closed(registry, conn):
+    """Count a connection as closed and keep its byte totals."""
+    registry['connections_closed_total'].inc()
+    registry['closed_bytes_received_total'].inc(conn.received)
+    registry['closed_bytes_sent_total'].inc(conn.sent)
+
+def listen(addr, port, reuseport=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((addr, port))
+    sock.listen(16)
+    sock.setblocking(0)
+    return sock
+
+def serve(listener, registry, timeout=1.0):
+    """Answer the connections waiting on listener.  Each one is
+    served in turn with blocking calls, each allowed timeout seconds:
+    scrapes are rare, and a response larger than the socket buffer
+    must still be sent whole."""
+
+    while True:
+        try:
+            (sock, addr) = listener.accept()
+        except OSError:
+            return
+        try:
+            body = registry.render().encode('utf-8')
+            sock.settimeout(timeout)
+            sock.sendall(
+                b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                + b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body)
+                + body
+            )
+            ## Closing with the request unread would reset the
+            ## connection and could lose the response, so finish
+            ## sending and read until the client hangs up.
+            sock.shutdown(socket.SHUT_WR)
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline and sock.recv(4096):
+                pass
+        except OSError:
+            pass
+        finally:
+            sock.close()
+
+class sampler(object):
+    """Log one message in every n through logger.  Logging each
+    request costs more than answering it."""
+
+    def __init__(self, logger, n=1000, level=logging.INFO):
+        self.logger = logger if isinstance(logger, logging.Logger) else logging.getLogger(logger)
+        self.n = n
+        self.level = level
+        self.count = 0
+
+    def __call__(self, msg, *args):
+        self.count += 1
+        if (self.count - 1) % self.n == 0:
+            self.logger.log(self.level, msg, *args)
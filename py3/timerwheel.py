@@ -0,0 +1,174 @@
+"""timerwheel -- a hierarchical timing wheel for connection timeouts.
+
+Copyright (c) 2009, Ben Weaver.  All rights reserved.
+This software is issued "as is" under a BSD license
+<http://orangesoda.net/license.html>.  All warranties disclaimed.
+
+Time is cut into ticks of a fixed resolution.  The first level of the
+wheel has one slot per tick for the next few dozen ticks; each level
+above it has slots that are a level's worth of ticks wide.  As time
+advances, the slots of a higher level are emptied into the levels
+below as their turn comes.  Arming, cancelling, and expiring a timer
+are O(1).
+
+Pushing a deadline later, which the servers do on every read, only
+stores the new deadline; a timer that comes up early is put back in
+the wheel.  The servers wait on their readiness backend for no longer
+than timeout() and then collect whatever advance() expires.
+
+    >>> w = wheel(now=0.0, resolution=0.1, slots=8)
+    >>> a = timer('a'); b = timer('b')
+    >>> w.arm(a, 0.5); w.arm(b, 30.0)
+    >>> w.timeout(0.0)
+    0.5
+    >>> w.arm(a, 2.0)
+    >>> [t.data for t in w.advance(1.0)], len(w)
+    ([], 2)
+    >>> [t.data for t in w.advance(2.0)], len(w)
+    (['a'], 1)
+    >>> [t.data for t in w.advance(29.9)]
+    []
+    >>> [t.data for t in w.advance(30.05)]
+    ['b']
+"""
+
+import math
+
+__all__ = ('timer', 'wheel')
+
+class timer(object):
+    """A deadline for data, usually a connection."""
+
+    __slots__ = ('deadline', 'data', '_slot')
+
+    def __init__(self, data=None):
+        self.deadline = None
+        self.data = data
+        self._slot = None
+
+    def __repr__(self):
+        return '<%s %r at %r>' % (type(self).__name__, self.data, self.deadline)
+
+    @property
+    def armed(self):
+        return self._slot is not None
+
+class wheel(object):
+
+    def __init__(self, now=0.0, resolution=0.05, slots=64, levels=4):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = [[set() for _ in range(slots)] for _ in range(levels)]
+
+        ## The last tick that has been expired.
+        self.tick = int(now / resolution)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def arm(self, t, when):
+        """Expire t at when.  Moving an armed timer later only
+        records the new deadline."""
+
+        if t._slot is not None:
+            if when >= t.deadline:
+                t.deadline = when
+                return
+            t._slot.discard(t); self.count -= 1
+        t.deadline = when
+        self._insert(t)
+
+    def cancel(self, t):
+        if t._slot is not None:
+            t._slot.discard(t); self.count -= 1
+            t._slot = None
+
+    def advance(self, now):
+        """Move the wheel forward to now and return the timers whose
+        deadlines have passed.  They are no longer armed."""
+
+        ## Allow for rounding when now came from timeout().
+        target = int(now / self.resolution + 1e-6)
+        expired = []
+
+        slots = self.slots; levels = self.levels
+        while self.tick < target:
+            if not self.count:
+                self.tick = target
+                break
+
+            self.tick += 1; tick = self.tick
+
+            ## Move the timers of each higher level whose slot has
+            ## come up down into the levels below.
+            width = slots
+            for level in levels[1:]:
+                if tick % width:
+                    break
+                slot = level[(tick // width) % slots]
+                if slot:
+                    self._reinsert(slot)
+                width *= slots
+
+            slot = levels[0][tick % slots]
+            if slot:
+                due = list(slot); slot.clear(); self.count -= len(due)
+                for t in due:
+                    t._slot = None
+                    if self._due(t.deadline) > tick:
+                        self._insert(t)
+                    else:
+                        expired.append(t)
+
+        return expired
+
+    def timeout(self, now):
+        """Seconds until the wheel next needs to advance, or None when
+        no timer is armed.  It may be early, never late."""
+
+        if not self.count:
+            return None
+
+        slots = self.slots; tick = self.tick
+        best = None; width = 1
+        for level in self.levels:
+            base = tick // width
+            for k in range(1, slots):
+                at = (base + k) * width
+                if best is not None and at >= best:
+                    break
+                if level[(base + k) % slots]:
+                    best = at
+                    break
+            width *= slots
+
+        return max(0.0, best * self.resolution - now)
+
+    def _due(self, when):
+        return int(math.ceil(when / self.resolution))
+
+    def _insert(self, t, soonest=1):
+        slots = self.slots; tick = self.tick
+        due = max(self._due(t.deadline), tick + soonest)
+
+        width = 1
+        for level in self.levels:
+            if due // width - tick // width < slots:
+                break
+            width *= slots
+        else:
+            ## Beyond the top level: park it in the farthest slot; it
+            ## is placed again when that slot comes up.
+            width //= slots
+            due = (tick // width + slots - 1) * width
+
+        slot = t._slot = level[(due // width) % slots]
+        slot.add(t); self.count += 1
+
+    def _reinsert(self, slot):
+        ## Timers due on this very tick go in the slot about to be
+        ## expired.
+        moving = list(slot); slot.clear(); self.count -= len(moving)
+        for t in moving:
+            self._insert(t, 0)